@@ -1,10 +1,11 @@
 from collections import defaultdict
+import os
 from random import random
 
 import numpy as np
-from tensorflow import keras
 
 import gamestate
+from npnet import NumpyDenseNetwork, QuantizedDenseNetwork, SparseInputNetwork
 
 
 class Agent:
@@ -15,6 +16,17 @@ class Agent:
 	def pick_draw(self, state, mask):
 		raise NotImplementedError()
 
+	# Batched versions take (n, 301) states and (n, 60, 2) / (n, 6) masks.
+	# By default they just loop over the single-state methods
+
+	def pick_plays(self, states, masks):
+		picks = [self.pick_play(state, mask) for state, mask in zip(states, masks)]
+		cards, is_discard = zip(*picks)
+		return np.array(cards), np.array(is_discard)
+
+	def pick_draws(self, states, masks):
+		return np.array([self.pick_draw(state, mask) for state, mask in zip(states, masks)])
+
 
 
 class RandomAgent(Agent):
@@ -22,40 +34,66 @@ class RandomAgent(Agent):
 
 	def pick_play(self, state, mask):
 		
-		# Random choice, with playing normalised against discarding
-		noise = np.random.random(mask.shape)
-		num_playable_cards = np.sum(mask[:, 0])
+		# Random choice over the legal actions only, with playing normalised against discarding
+		actions = np.flatnonzero(mask)
+		noise = np.random.random(actions.size)
+		is_play = actions % 2 == 0
+		num_playable_cards = np.count_nonzero(is_play)
 		if num_playable_cards:
-			noise[:, 0] = 1 - ((num_playable_cards / 8) * noise[:, 0] / self.PLAY_VS_DISCARD_WEIGHTING)
-		choice = np.argmax(noise * mask)
+			noise[is_play] = 1 - ((num_playable_cards / 8) * noise[is_play] / self.PLAY_VS_DISCARD_WEIGHTING)
+		choice = actions[np.argmax(noise)]
 
 		card, is_discard = divmod(choice, 2)
 		return card, is_discard
 
 	def pick_draw(self, state, mask):
-		return np.argmax(np.random.random(mask.size) * mask)
+		actions = np.flatnonzero(mask)
+		return actions[np.random.randint(actions.size)]
+
+	def pick_plays(self, states, masks):
+		noise = np.random.random(masks.shape)
+		num_playable_cards = np.sum(masks[:, :, 0], axis=1)
+		noise[:, :, 0] = 1 - ((num_playable_cards[:, None] / 8) * noise[:, :, 0] / self.PLAY_VS_DISCARD_WEIGHTING)
+		choices = np.argmax((noise * masks).reshape((masks.shape[0], -1)), axis=1)
+		return np.divmod(choices, 2)
+
+	def pick_draws(self, states, masks):
+		return np.argmax(np.random.random(masks.shape) * masks, axis=1)
 
 
 
 class DenseAgent(Agent):
 
-	def __init__(self, exploration_prob=0, existing_agent=None):
+	def __init__(self, exploration_prob=0, existing_agent=None, shared_trunk=False):
+		""" With shared_trunk=True the play and draw networks are two heads on one trunk,
+		trained together through self.model, see build_dense_shared_network """
 		self.exploration_prob = exploration_prob
 		if exploration_prob != 0:
 			self.random_agent = RandomAgent()
 
-		if existing_agent is None:
-			self.play_model = build_dense_play_network()
-			self.draw_model =  build_dense_draw_network()
-		else:
+		if existing_agent is not None:
+			self.model = existing_agent.model
 			self.play_model = existing_agent.play_model
 			self.draw_model = existing_agent.draw_model
+		elif shared_trunk:
+			self.model, self.play_model, self.draw_model = build_dense_shared_network()
+		else:
+			self.model = None
+			self.play_model = build_dense_play_network()
+			self.draw_model =  build_dense_draw_network()
+
+	def play_values(self, states):
+		""" Predicted final score delta of each of the 120 play actions, for a batch of states """
+		return np.asarray(self.play_model(states))
+
+	def draw_values(self, states):
+		return np.asarray(self.draw_model(states))
 
 	def pick_play(self, state, mask):
 		if random() < self.exploration_prob:
 			return self.random_agent.pick_play(state, mask)
 
-		results = self.play_model(state[None, :])
+		results = self.play_values(state[None, :])
 		choice = np.argmax(np.ma.array(results, mask=np.logical_not(mask)))
 		card, is_discard = divmod(choice, 2)
 		return card, is_discard
@@ -64,16 +102,118 @@ class DenseAgent(Agent):
 		if random() < self.exploration_prob:
 			return self.random_agent.pick_draw(state, mask)
 
-		results = self.draw_model(state[None, :])
+		results = self.draw_values(state[None, :])
 		choice = np.argmax(np.ma.array(results, mask=np.logical_not(mask)))
 		return choice
 
+	def pick_plays(self, states, masks):
+		masks = masks.reshape((masks.shape[0], -1))
+		results = self.play_values(states)
+		choices = np.argmax(np.where(masks, results, -np.inf), axis=1)
+		cards, is_discard = np.divmod(choices, 2)
+
+		explore = np.random.random(choices.size) < self.exploration_prob
+		if np.any(explore):
+			cards[explore], is_discard[explore] = self.random_agent.pick_plays(
+				states[explore], masks[explore].reshape((-1, 60, 2)))
+		return cards, is_discard
+
+	def pick_draws(self, states, masks):
+		results = self.draw_values(states)
+		choices = np.argmax(np.where(masks, results, -np.inf), axis=1)
+
+		explore = np.random.random(choices.size) < self.exploration_prob
+		if np.any(explore):
+			choices[explore] = self.random_agent.pick_draws(states[explore], masks[explore])
+		return choices
+
 	def compile_models_for_training(self, loss):
-		self.play_model.compile(loss=loss, optimizer='adam')
-		self.draw_model.compile(loss=loss, optimizer='adam')
+		if self.model is not None:
+			self.model.compile(loss=[loss, loss], optimizer='adam')
+		else:
+			self.play_model.compile(loss=loss, optimizer='adam')
+			self.draw_model.compile(loss=loss, optimizer='adam')
+
+
+class NumpyDenseAgent(DenseAgent):
+	""" DenseAgent that runs inference through NumPy copies of its Keras networks.
+	Call refresh() after training the Keras models further """
+
+	def __init__(self, exploration_prob=0, existing_agent=None):
+		super().__init__(exploration_prob, existing_agent)
+		self.refresh()
+
+	def refresh(self):
+		self.set_networks(NumpyDenseNetwork.from_keras(self.play_model), NumpyDenseNetwork.from_keras(self.draw_model))
+
+	def set_networks(self, play_net, draw_net):
+		self.play_net = play_net
+		self.draw_net = draw_net
+
+	def save(self, directory):
+		""" Checkpoint the networks as play.npz and draw.npz in directory """
+		os.makedirs(directory, exist_ok=True)
+		self.play_net.save(os.path.join(directory, 'play.npz'))
+		self.draw_net.save(os.path.join(directory, 'draw.npz'))
+
+	@classmethod
+	def load(cls, directory, exploration_prob=0):
+		""" Agent playing saved networks. No Keras models are built, so TensorFlow is not
+		needed, but refresh() and training are unavailable """
+		agent = cls.__new__(cls)
+		agent.exploration_prob = exploration_prob
+		if exploration_prob != 0:
+			agent.random_agent = RandomAgent()
+		agent.model = agent.play_model = agent.draw_model = None
+		agent.set_networks(
+			NumpyDenseNetwork.load(os.path.join(directory, 'play.npz')),
+			NumpyDenseNetwork.load(os.path.join(directory, 'draw.npz')),
+		)
+		return agent
+
+	def play_values(self, states):
+		return self.play_net(states)
+
+	def draw_values(self, states):
+		return self.draw_net(states)
+
+
+class QuantizedDenseAgent(NumpyDenseAgent):
+	""" NumpyDenseAgent running simulated int8-quantized copies of its networks, to see
+	how int8 inference would play. It is no faster than NumpyDenseAgent. The float copies
+	are kept as play_net/draw_net for comparison, see npnet.quantization_report """
+
+	def set_networks(self, play_net, draw_net):
+		super().set_networks(play_net, draw_net)
+		self.play_qnet = QuantizedDenseNetwork.from_network(play_net)
+		self.draw_qnet = QuantizedDenseNetwork.from_network(draw_net)
+
+	def play_values(self, states):
+		return self.play_qnet(states)
+
+	def draw_values(self, states):
+		return self.draw_qnet(states)
+
+
+class SparseInputDenseAgent(NumpyDenseAgent):
+	""" NumpyDenseAgent whose first layers only read the active (card, zone) features,
+	see npnet.SparseInputNetwork """
+
+	def set_networks(self, play_net, draw_net):
+		super().set_networks(play_net, draw_net)
+		self.play_snet = SparseInputNetwork(play_net)
+		self.draw_snet = SparseInputNetwork(draw_net)
+
+	def play_values(self, states):
+		return self.play_snet(states)
+
+	def draw_values(self, states):
+		return self.draw_snet(states)
 
 
 def build_dense_play_network():
+	from tensorflow import keras  # imported here so agents without networks start without TensorFlow
+
 	hidden_units = 1024
 	hidden_layers = 3
 	
@@ -88,6 +228,8 @@ def build_dense_play_network():
 
 
 def build_dense_draw_network():
+	from tensorflow import keras
+
 	hidden_units = 1024
 	hidden_layers = 3
 	
@@ -100,101 +242,137 @@ def build_dense_draw_network():
 	model.add(keras.layers.Dense(6, activation=None))
 	return model
 
-tmp = [0]
 
-class MinAgent(Agent):
-	def __init__(self, play_handshakes=False, play_drawn_cards_weighting=1.0):
-		self.play_handshakes = play_handshakes
-		self.play_drawn_cards_weighting = play_drawn_cards_weighting
-		self.random_agent = RandomAgent()
+def build_dense_shared_network():
+	""" One trunk feeding a play head and a draw head. Returns the joint model, mapping
+	(play state, draw state) to (play values, draw values) for training, and the
+	single-input play and draw models, which share its layers """
+	from tensorflow import keras
 
-	def pick_play(self, state, mask):
-		deck_size = state[-1]
-		card_features = state[:-1].reshape((60, 5)) > 0
-		played_multipliers = np.sum(card_features[:, 1].reshape(5, 12)[:, :3], axis=1) + 1
-		empty_stacks = np.sum(card_features[:, 1].reshape(5, 12), axis=1) == 0
+	hidden_units = 1024
+	hidden_layers = 3
 
-		in_hand = card_features[:, 0]
-		unseen = np.sum(card_features, axis=-1) == 0
-		draw_unseen_chance = deck_size / (2 * (deck_size + 8))
-		play_unseen_chance = draw_unseen_chance * self.play_drawn_cards_weighting
-		probabilities = in_hand * 1 + unseen * play_unseen_chance
-
-		# Take card base values
-		expected_worth = np.arange(60, dtype=np.float32).reshape((5, 12)) % 12 - 1
-		expected_worth[:, :3] = 0
-		# Multiply by probability of holding in hand at some point
-		expected_worth *= probabilities.reshape((5, 12))
-
-		# zero out cards that can't be played
-		stack_maxes = [0] * 5
-		for card_idx in np.where(card_features[:, 1])[0]:
-			colour, value = gamestate.Card.idx_to_colour_and_value(card_idx)
-			stack_maxes[colour] = max(stack_maxes[colour], value)
-		for stack, stack_max in enumerate(stack_maxes):
-			expected_worth[stack, :stack_max+2] = 0
-
-		# apply handshake multipliers
-		expected_worth *= played_multipliers[:, None]
-
-		# Cost of playing a card (opportunity cost and new venture penalty)
-		play_costs = expected_worth.copy()
-		play_costs[:, 0] += 20 * empty_stacks
-		play_costs = np.cumsum(play_costs, axis=1)
-		play_costs = np.roll(play_costs, 1, axis=1)
-		play_costs[:, 0] = play_costs[:, 1]  # 0
-		play_costs = play_costs.flatten()
-
-		# If we play a card, it will be the one minimising the opportunity cost
-		# whlst still allowing best cards to be played at the end
-		values_in_hand = expected_worth.flatten() * in_hand
-		num_cards_worth_playing = np.count_nonzero(values_in_hand)
-		remaining_turns = 1 + (deck_size - 1) // 2
-		if remaining_turns < num_cards_worth_playing:
-			cards = list(np.where(values_in_hand)[0])
-			cards.sort(lambda x: values_in_hand[x], reverse=True)
-			card_to_play = cards[remaining_turns - 1]
+	trunk = [keras.layers.Dense(hidden_units, activation='relu') for _ in range(hidden_layers)]
+	play_head = keras.layers.Dense(60 * 2, activation=None)
+	draw_head = keras.layers.Dense(6, activation=None)
 
-		else:
-			card_to_play = np.argmin(play_costs * in_hand)
-		play_card_cost = play_costs[card_to_play]
-		
+	def apply(x, head):
+		for layer in trunk:
+			x = layer(x)
+		return head(x)
 
+	play_input = keras.Input(shape=(60 * 5 + 1))
+	draw_input = keras.Input(shape=(60 * 5 + 1))
+	play_output = apply(play_input, play_head)
+	draw_output = apply(draw_input, draw_head)
 
-		""" 
-		Play / discard decided by
-			-summing top (deck_size//2) expected values to predict points to be score,
-			  subtracting points scored by playing one fewer cards to find opportinuity cost of 
-			  discarding
-			- increase opportunity cost of discarding by max potential value of discarded card to 
-			  opponent
-			- compare against opportinuty cost of playing lowest cost card in hand
-		"""
+	model = keras.Model([play_input, draw_input], [play_output, draw_output])
+	return model, keras.Model(play_input, play_output), keras.Model(draw_input, draw_output)
 
+class MinAgent(Agent):
+	""" Heuristic agent minimising opportunity cost, batched over (N, 301) states.
 
+	Every card I could still play is worth its value times my handshake multiplier,
+	weighted by the chance of holding it: 1 in hand, play_drawn_cards_weighting times the
+	share of unseen cards I'll draw otherwise. Playing a card costs the worth of the lower
+	cards of its colour it rules out, plus, to open an expedition, however much of its 20
+	point cost the colour's total worth doesn't cover. Discarding costs the
+	worth of the last card I'd have had time to play, plus what the discarded card is worth
+	to the opponent. The cheaper of the two is taken """
 
-		tmp[0] += 1
-		if tmp[0] > 1:
-			print(empty_stacks)
-			for i, (f, c, E) in enumerate(zip(card_features, play_costs.flatten(), expected_worth.flatten())):
-				if E:
-					print(f'{i % 12 - 1: 3d} {f} {E: 2.2f} {c: 2.2f}')
-				else:
-					print(f'{i % 12 - 1: 3d} {f} -')
-				if i % 12 == 11:
-					print('------------------------------------------------')
+	OPEN_EXPEDITION_COST = 20
 
-			print(f'{card_to_play=} {play_card_cost=}')
-			quit()
+	def __init__(self, play_handshakes=False, play_drawn_cards_weighting=1.0):
+		self.play_handshakes = play_handshakes
+		self.play_drawn_cards_weighting = play_drawn_cards_weighting
 
-		# Potential_values
-		
-		return self.random_agent.pick_play(state, mask)
+	def pick_play(self, state, mask):
+		cards, is_discard = self.pick_plays(state[None, :], mask[None])
+		return cards[0], is_discard[0]
+
+	def pick_draw(self, state, mask):
+		return self.pick_draws(state[None, :], mask[None])[0]
 
 
+	@staticmethod
+	def _stack_tops(stacks):
+		""" (N, 5, 12) stack membership -> (N, 5) index of each top card, -1 if empty """
+		return np.where(np.any(stacks, axis=-1), 11 - np.argmax(stacks[..., ::-1], axis=-1), -1)
 
-	def pick_draw(self, state, mask):
-		return self.random_agent.pick_draw(state, mask)
+	@staticmethod
+	def _multipliers(stacks):
+		return np.sum(stacks[..., :3], axis=-1) + 1
+
+	def pick_plays(self, states, masks):
+		n = states.shape[0]
+		deck_size = states[:, -1]
+		card_features = states[:, :60 * 5].reshape((n, 60, 5)) > 0
+		my_stacks = card_features[:, :, gamestate.MY_STACK_FEATURE].reshape((n, 5, 12))
+		opponent_stacks = card_features[:, :, gamestate.OPPONENT_STACK_FEATURE].reshape((n, 5, 12))
+		in_hand = card_features[:, :, gamestate.HAND_FEATURE]
+		unseen = ~np.any(card_features, axis=-1)
+		ranks = np.arange(12)
+
+		# Worth of every card to me, and to the opponent, while it can still go on a stack
+		draw_unseen_chance = deck_size / (2 * (deck_size + 8))
+		probabilities = in_hand + unseen * (draw_unseen_chance * self.play_drawn_cards_weighting)[:, None]
+		values = gamestate.CARD_VALUES.reshape((5, 12)).astype(np.float32)
+		my_playable = ranks > self._stack_tops(my_stacks)[..., None]
+		worth = values * probabilities.reshape((n, 5, 12)) * my_playable * self._multipliers(my_stacks)[..., None]
+		opponent_playable = ranks > self._stack_tops(opponent_stacks)[..., None]
+		opponent_worth = values * opponent_playable * self._multipliers(opponent_stacks)[..., None]
+
+		# Playing a card rules out the lower ones of its colour, and opening an expedition
+		# costs whatever the colour is not expected to win back
+		empty_stacks = ~np.any(my_stacks, axis=-1)
+		opening_costs = empty_stacks * (self.OPEN_EXPEDITION_COST - np.sum(worth, axis=-1))
+		play_costs = np.cumsum(worth, axis=-1) - worth + opening_costs[..., None]
+		play_costs = play_costs.reshape((n, 60))
+		worth = worth.reshape((n, 60))
+		opponent_worth = opponent_worth.reshape((n, 60))
+
+		# With fewer turns left than cards worth playing, play the least valuable card that
+		# still makes the cut, otherwise the cheapest
+		can_play = masks[:, :, 0].copy()
+		if not self.play_handshakes:
+			can_play[:, gamestate.CARD_IS_HANDSHAKE] = False
+		hand_worth = np.where(can_play, worth, 0)
+		remaining_turns = 1 + (deck_size.astype(int) - 1) // 2
+		rows = np.arange(n)
+		ranked = np.argsort(-hand_worth, axis=1, kind='stable')
+		cutoff_card = ranked[rows, np.clip(remaining_turns - 1, 0, 59)]
+		short_of_turns = remaining_turns < np.count_nonzero(hand_worth, axis=1)
+		play_cards = np.where(short_of_turns, cutoff_card, np.argmin(np.where(can_play, play_costs, np.inf), axis=1))
+		play_cost = np.where(np.any(can_play, axis=1), play_costs[rows, play_cards], np.inf)
+
+		# Discarding wastes a turn, i.e. the last card there would have been time to play
+		future_worth = -np.sort(-worth, axis=1)
+		turn_cost = future_worth[rows, np.clip(remaining_turns - 1, 0, 59)]
+		discard_costs = np.where(masks[:, :, 1], worth + opponent_worth, np.inf)
+		discard_cards = np.argmin(discard_costs, axis=1)
+		discard_cost = turn_cost + opponent_worth[rows, discard_cards]
+
+		is_discard = discard_cost < play_cost
+		return np.where(is_discard, discard_cards, play_cards), is_discard.astype(int)
+
+	def pick_draws(self, states, masks):
+		""" Take a discard pile top I could still play if it beats the average unseen card,
+		otherwise draw from the deck """
+		n = states.shape[0]
+		card_features = states[:, :60 * 5].reshape((n, 60, 5)) > 0
+		my_stacks = card_features[:, :, gamestate.MY_STACK_FEATURE].reshape((n, 5, 12))
+		playable = np.arange(12) > self._stack_tops(my_stacks)[..., None]
+		worth = gamestate.CARD_VALUES.reshape((5, 12)) * playable * self._multipliers(my_stacks)[..., None]
+		worth = worth.reshape((n, 60))
+
+		unseen = ~np.any(card_features, axis=-1)
+		deck_worth = np.sum(worth * unseen, axis=1) / np.maximum(np.count_nonzero(unseen, axis=1), 1)
+		tops = card_features[:, :, gamestate.DISCARD_TOP_FEATURE]
+		pile_worth = np.max(np.where(tops, worth, -1).reshape((n, 5, 12)), axis=-1)
+		pile_worth = np.where(masks[:, :gamestate.NUM_COLOURS], pile_worth, -1)
+
+		best_pile = np.argmax(pile_worth, axis=1)
+		return np.where(pile_worth[np.arange(n), best_pile] > deck_worth, best_pile, gamestate.DECK)
 
 
 if __name__ == "__main__":
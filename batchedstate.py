@@ -0,0 +1,183 @@
+import numpy as np
+
+from gamestate import CARD_COLOURS, CARD_VALUES, NUM_COLOURS, DECK
+
+
+"""
+Array-backed version of gamestate.GameState that advances many games in lockstep.
+
+Every method takes an optional `games` index array selecting which games the call
+applies to (default all of them), and actions are given as one entry per selected
+game. Players are stored in absolute order and `current_player` picks the
+perspective, so swapping is a flag flip rather than a copy.
+
+Features and masks come out in exactly the same layout as the scalar engine:
+	features      (n, 60 * 5 + 1) float32
+	play masks    (n, 60, 2) bool
+	draw masks    (n, 6) bool
+"""
+
+NO_PILE = -1
+
+
+class BatchedGameState:
+
+	def __init__(self, num_games):
+		self.num_games = num_games
+
+	def init_random_games(self, rng=None):
+		if rng is None:
+			rng = np.random.default_rng()
+		N = self.num_games
+
+		self.current_player = np.zeros(N, dtype=np.int8)
+		self.illegal_draw_pile = np.full(N, NO_PILE, dtype=np.int8)
+
+		# Cards are drawn from the end of the deck, as in GameState
+		self.deck = rng.permuted(np.tile(np.arange(60, dtype=np.int8), (N, 1)), axis=1)
+		self.deck_size = np.full(N, 60 - 16, dtype=np.int32)
+
+		self.discard_piles = np.zeros((N, NUM_COLOURS, 12), dtype=np.int8)
+		self.discard_lens = np.zeros((N, NUM_COLOURS), dtype=np.int8)
+		self.discard_positions = np.full((N, 60), -1, dtype=np.int8)
+		self.stacks = np.zeros((N, 2, 60), dtype=bool)
+		self.stack_tops = np.full((N, 2, NUM_COLOURS), -1, dtype=np.int8)
+
+		self.hands = np.zeros((N, 2, 60), dtype=bool)
+		games = np.arange(N)[:, None]
+		self.hands[games, 0, self.deck[:, 52:]] = True
+		self.hands[games, 1, self.deck[:, 44:52]] = True
+
+
+	def _select(self, games):
+		if games is None:
+			return np.arange(self.num_games)
+		return np.asarray(games)
+
+
+	def swap_player(self, games=None):
+		g = self._select(games)
+		self.current_player[g] ^= 1
+
+
+	def do_play(self, card_indices, is_discard, games=None):
+		g = self._select(games)
+		cards = np.asarray(card_indices)
+		is_discard = np.asarray(is_discard, dtype=bool)
+		players = self.current_player[g]
+
+		if not np.all(self.hands[g, players, cards]):
+			raise ValueError("Tried to use card not in hand")
+		self.hands[g, players, cards] = False
+		colours = CARD_COLOURS[cards]
+
+		self.illegal_draw_pile[g] = NO_PILE
+		dg, dcards, dcolours = g[is_discard], cards[is_discard], colours[is_discard]
+		positions = self.discard_lens[dg, dcolours]
+		self.discard_piles[dg, dcolours, positions] = dcards
+		self.discard_positions[dg, dcards] = positions
+		self.discard_lens[dg, dcolours] += 1
+		self.illegal_draw_pile[dg] = dcolours
+
+		is_play = ~is_discard
+		pg, pplayers, pcards = g[is_play], players[is_play], cards[is_play]
+		self.stacks[pg, pplayers, pcards] = True
+		self.stack_tops[pg, pplayers, colours[is_play]] = CARD_VALUES[pcards]
+
+
+	def do_draw(self, choices, games=None):
+		g = self._select(games)
+		choices = np.asarray(choices)
+		if np.any(choices == self.illegal_draw_pile[g]):
+			raise ValueError("Tried to draw from the pile just discarded to")
+		self.illegal_draw_pile[g] = NO_PILE
+		drawn = np.empty(g.size, dtype=np.int8)
+
+		from_deck = choices == DECK
+		kg = g[from_deck]
+		self.deck_size[kg] -= 1
+		drawn[from_deck] = self.deck[kg, self.deck_size[kg]]
+
+		from_pile = ~from_deck
+		pg, colours = g[from_pile], choices[from_pile]
+		if np.any(self.discard_lens[pg, colours] == 0):
+			raise ValueError("Tried to draw from an empty discard pile")
+		self.discard_lens[pg, colours] -= 1
+		pile_cards = self.discard_piles[pg, colours, self.discard_lens[pg, colours]]
+		self.discard_positions[pg, pile_cards] = -1
+		drawn[from_pile] = pile_cards
+
+		self.hands[g, self.current_player[g], drawn] = True
+		return drawn
+
+
+	def get_features(self, games=None, out=None):
+		g = self._select(games)
+		if out is None:
+			out = np.empty((g.size, 60 * 5 + 1), dtype=np.float32)
+		players = self.current_player[g]
+		card_features = out[:, :60 * 5].reshape((g.size, 60, 5))
+
+		card_features[:, :, 0] = np.where(self.hands[g, players], 1, -1)
+		card_features[:, :, 1] = np.where(self.stacks[g, players], 1, -1)
+		card_features[:, :, 2] = np.where(self.stacks[g, 1 - players], 1, -1)
+
+		positions = self.discard_positions[g]
+		depths = self.discard_lens[g][:, CARD_COLOURS] - 1 - positions
+		in_discard = positions >= 0
+		card_features[:, :, 3] = np.where(in_discard & (depths == 0), 1, -1)
+		card_features[:, :, 4] = np.where(in_discard, depths, 0)
+
+		out[:, -1] = self.deck_size[g]
+		return out
+
+
+	def get_legal_play_masks(self, games=None):
+		g = self._select(games)
+		players = self.current_player[g]
+		in_hand = self.hands[g, players]
+		stack_tops = self.stack_tops[g, players][:, CARD_COLOURS]
+
+		masks = np.empty((g.size, 60, 2), dtype=bool)
+		np.logical_and(in_hand, CARD_VALUES >= stack_tops, out=masks[:, :, 0])
+		masks[:, :, 1] = in_hand  # can always discard from hand
+		return masks
+
+
+	def get_legal_draw_masks(self, games=None):
+		g = self._select(games)
+		masks = np.ones((g.size, 6), dtype=bool)
+		masks[:, :NUM_COLOURS] = self.discard_lens[g] > 0
+		illegal = self.illegal_draw_pile[g]
+		has_illegal = illegal != NO_PILE
+		masks[np.flatnonzero(has_illegal), illegal[has_illegal]] = False
+		return masks
+
+
+	def get_play_features(self, games=None):
+		return self.get_features(games), self.get_legal_play_masks(games)
+
+	def get_draw_features(self, games=None):
+		return self.get_features(games), self.get_legal_draw_masks(games)
+
+
+	def is_finished(self, games=None):
+		return self.deck_size[self._select(games)] == 0
+
+
+	def get_scores(self, games=None):
+		""" (n, 2, 5) per-colour scores, current player first as in GameState.get_scores """
+		g = self._select(games)
+		players = self.current_player[g]
+		stacks = np.stack((self.stacks[g, players], self.stacks[g, 1 - players]), axis=1)
+		stacks = stacks.reshape((g.size, 2, NUM_COLOURS, 12))
+
+		totals = stacks @ CARD_VALUES[:12]  # every colour has the same values
+		handshakes = np.sum(stacks[..., :3], axis=-1)
+		lengths = np.sum(stacks, axis=-1)
+		scores = (totals - 20) * (1 + handshakes) + 20 * (lengths >= 8)
+		return np.where(lengths > 0, scores, 0).astype(np.int32)
+
+	def get_score_deltas(self, games=None):
+		scores = self.get_scores(games)
+		return np.sum(scores[:, 0], axis=-1) - np.sum(scores[:, 1], axis=-1)
@@ -0,0 +1,229 @@
+import argparse
+from collections import defaultdict
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from agent import RandomAgent, DenseAgent, NumpyDenseAgent
+from bitstate import BitGameState
+from gamestate import GameState
+import train
+
+
+"""
+Benchmark suite for the game engines, agents and training loop.
+
+Every benchmark reseeds random, numpy and (when used) TensorFlow before it runs, so a
+given commit always plays the same games and trains on the same data. Timings are the
+median of a few repeats. Results are printed as JSON and appended as one line to
+bench_output.txt, tagged with the commit and library versions, so runs on different
+commits can be compared:
+
+	python bench.py [--quick] [--only engine play_match ...]
+"""
+
+SEED = 0
+BATCH_SIZES = (1, 32, 256)
+ENGINE_CALLS = ('_get_features', '_get_legal_play_mask', 'do_play', '_get_legal_draw_mask', 'do_draw')
+
+
+def _seed(tensorflow=False):
+	random.seed(SEED)
+	np.random.seed(SEED)
+	if tensorflow or 'tensorflow' in sys.modules:
+		import tensorflow as tf
+		tf.random.set_seed(SEED)
+
+
+def _median_time(f, repeats):
+	times = []
+	for _ in range(repeats):
+		_seed()
+		start = time.perf_counter()
+		f()
+		times.append(time.perf_counter() - start)
+	return statistics.median(times)
+
+
+def _engine_game(state_class, rng, timings):
+	""" Play one game of uniformly random legal moves, adding the nanoseconds spent in each
+	engine call to timings. Returns the number of turns """
+	clock = time.perf_counter_ns
+	state = state_class()
+	state.init_random_game()
+	turns = 0
+	while not state.is_finished():
+		t0 = clock()
+		state._get_features()
+		t1 = clock()
+		state._get_legal_play_mask()
+		t2 = clock()
+		action = rng.choice(state.get_legal_play_actions())
+		t3 = clock()
+		state.do_play(action >> 1, action & 1)
+		t4 = clock()
+		state._get_legal_draw_mask()
+		t5 = clock()
+		draw = rng.choice(state.get_legal_draw_actions())
+		t6 = clock()
+		state.do_draw(draw)
+		t7 = clock()
+		state.swap_player()
+
+		timings['_get_features'] += t1 - t0
+		timings['_get_legal_play_mask'] += t2 - t1
+		timings['do_play'] += t4 - t3
+		timings['_get_legal_draw_mask'] += t5 - t4
+		timings['do_draw'] += t7 - t6
+		turns += 1
+	return turns
+
+
+def bench_engine(num_games):
+	""" Nanoseconds per call of the core engine methods, for each engine """
+	results = {}
+	for state_class in (GameState, BitGameState):
+		_seed()
+		rng = random.Random(SEED)
+		timings = defaultdict(int)
+		turns = sum(_engine_game(state_class, rng, timings) for _ in range(num_games))
+		results[state_class.__name__] = {f'{name}_ns': timings[name] / turns for name in ENGINE_CALLS}
+	return results
+
+
+def bench_play_match(num_games, repeats):
+	""" Games per second of train.play_match between two RandomAgents """
+	results = {}
+	for state_class in (GameState, BitGameState):
+		agent = RandomAgent()
+		seconds = _median_time(
+			lambda: [train.play_match(agent, agent, state_class=state_class) for _ in range(num_games)], repeats)
+		results[state_class.__name__] = {'games_per_s': num_games / seconds}
+	return results
+
+
+def bench_self_play(num_games, batch_size, repeats):
+	""" Training positions (turns) per second generated by RandomAgent self-play, one game
+	at a time and batch_size games in lockstep """
+	agent = RandomAgent()
+	_seed()
+	positions = sum(train.self_play_match(agent)[0].shape[0] for _ in range(num_games))
+	seconds = _median_time(lambda: [train.self_play_match(agent) for _ in range(num_games)], repeats)
+
+	_seed()
+	batched_positions = sum(
+		game[0].shape[0] for game in train.batched_self_play(agent, batch_size, rng=np.random.default_rng(SEED)))
+	batched_seconds = _median_time(
+		lambda: train.batched_self_play(agent, batch_size, rng=np.random.default_rng(SEED)), repeats)
+
+	return {
+		'self_play_match': {'positions_per_s': positions / seconds},
+		'batched_self_play': {'positions_per_s': batched_positions / batched_seconds},
+	}
+
+
+def _sample_positions(num_positions):
+	_seed()
+	agent = RandomAgent()
+	positions = []
+	while sum(map(len, positions)) < num_positions:
+		positions.append(train.self_play_match(agent)[0])
+	return np.concatenate(positions)[:num_positions]
+
+
+def bench_inference(repeats, calls=20):
+	""" DenseAgent play-network latency per call at several batch sizes, through Keras and
+	through the NumPy copy """
+	_seed(tensorflow=True)
+	keras_agent = DenseAgent()
+	numpy_agent = NumpyDenseAgent(existing_agent=keras_agent)
+	states = _sample_positions(max(BATCH_SIZES))
+
+	results = {}
+	for name, agent in (('keras', keras_agent), ('numpy', numpy_agent)):
+		for batch_size in BATCH_SIZES:
+			batch = states[:batch_size]
+			agent.play_values(batch)  # warm up
+			seconds = _median_time(lambda: [agent.play_values(batch) for _ in range(calls)], repeats) / calls
+			results[f'{name}_batch_{batch_size}'] = {
+				'latency_us': seconds * 1e6,
+				'positions_per_s': batch_size / seconds,
+			}
+	return results
+
+
+def bench_training(num_games, repeats):
+	""" Rows per second through one epoch of fitting the play and draw networks on
+	RandomAgent self-play data, as in train.train """
+	_seed()
+	agent = RandomAgent()
+	trajectories = [train.self_play_match(agent) for _ in range(num_games)]
+	play_X, draw_X, play_Y, draw_Y = (np.concatenate(column) for column in zip(*trajectories))
+	play_Y = train.target_pairs(*train.sparse_targets(play_Y))
+	draw_Y = train.target_pairs(*train.sparse_targets(draw_Y))
+	chunks = [(play_X, draw_X, play_Y, draw_Y)]
+
+	results = {}
+	for shared_trunk in (False, True):
+		_seed(tensorflow=True)
+		training_agent = DenseAgent(shared_trunk=shared_trunk)
+		training_agent.compile_models_for_training(loss=train.squared_error_sparse)
+
+		def fit():
+			if shared_trunk:
+				training_agent.model.fit(train.trajectory_datasets(lambda: chunks, joint=True), epochs=1, verbose=0)
+			else:
+				play_dataset, draw_dataset = train.trajectory_datasets(lambda: chunks)
+				training_agent.play_model.fit(play_dataset, epochs=1, verbose=0)
+				training_agent.draw_model.fit(draw_dataset, epochs=1, verbose=0)
+
+		fit()  # trace the training functions outside the timing
+		seconds = _median_time(fit, repeats)
+		results['shared_trunk' if shared_trunk else 'separate'] = {'rows_per_s': play_X.shape[0] / seconds}
+	return results
+
+
+def _environment():
+	try:
+		commit = subprocess.run(
+			['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+
+	versions = {'python': platform.python_version(), 'numpy': np.__version__}
+	if 'tensorflow' in sys.modules:
+		versions['tensorflow'] = sys.modules['tensorflow'].__version__
+	return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': platform.machine(), **versions}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the engines, agents and training loop')
+	parser.add_argument('--quick', action='store_true', help='fewer games and repeats, for a smoke test')
+	parser.add_argument('--only', nargs='+', metavar='NAME', help='only run these benchmarks')
+	parser.add_argument('--output', default='bench_output.txt', help='file to append the JSON line to')
+	args = parser.parse_args()
+
+	games, repeats = (5, 1) if args.quick else (50, 3)
+	benchmarks = {
+		'engine': lambda: bench_engine(games),
+		'play_match': lambda: bench_play_match(games, repeats),
+		'self_play': lambda: bench_self_play(games, 4 * games, repeats),
+		'inference': lambda: bench_inference(repeats),
+		'training': lambda: bench_training(games // 5, repeats),
+	}
+	results = {}
+	for name, run in benchmarks.items():
+		if args.only is None or name in args.only:
+			results[name] = run()
+
+	report = {**_environment(), 'seed': SEED, 'quick': args.quick, 'results': results}
+	json.dump(report, sys.stdout, indent=2)
+	print()
+	with open(args.output, 'a') as f:
+		f.write(json.dumps(report) + '\n')
@@ -0,0 +1,311 @@
+from random import shuffle
+import struct
+
+import numpy as np
+
+from gamestate import CARD_COLOURS, NUM_COLOURS, DECK, score_stack
+
+
+"""
+Compact drop-in alternative to gamestate.GameState.
+
+Hands and stacks are 60-bit integer masks (bit i set <=> card i present), discard
+piles are one 5x12 bytearray of card indices plus a length per pile, and the deck
+is an immutable bytes object shared between clones with a cursor into it. Copying
+a state is therefore a handful of attribute copies, and the whole thing hashes and
+serialises to a few dozen bytes.
+
+Each colour occupies 12 consecutive bits: three handshakes then values 2..10, so
+the highest set bit of a stack's segment is always its top card.
+"""
+
+COLOUR_BITS = 0xFFF
+NO_PILE = 0xFF
+
+_COLOURS = tuple(CARD_COLOURS.tolist())
+_SEGMENT_SCORES = tuple(
+	score_stack([i for i in range(12) if segment >> i & 1])
+	for segment in range(1 << 12)
+)
+# Cards that may go on a colour's stack, given that colour's 12-bit segment of the stack
+_SEGMENT_PLAYABLE = tuple(
+	COLOUR_BITS if segment.bit_length() <= 3 else COLOUR_BITS & ~((1 << segment.bit_length()) - 1)
+	for segment in range(1 << 12)
+)
+_STRUCT = struct.Struct('<4Q60s60s5sBBB')
+
+# The 8 bits of every byte value, least significant first, as raw bool and as +1 / -1
+# float32 bytes. Masks are expanded by joining these and viewing the result with NumPy,
+# which costs far less than unpacking with a chain of NumPy calls
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder='little').astype(bool)
+_BYTE_BOOL_BYTES = tuple(bits.tobytes() for bits in _BYTE_BITS)
+_BYTE_SIGN_BYTES = tuple(np.where(bits, 1, -1).astype(np.float32).tobytes() for bits in _BYTE_BITS)
+# Discard top and covered columns with every discard pile empty, 64 entries each
+_EMPTY_DISCARD_BYTES = np.repeat(np.array([-1, 0], dtype=np.float32), 64).tobytes()
+
+# Read-only draw masks, indexed by the bit mask of piles that may be drawn from
+_DRAW_MASKS = tuple(
+	np.array([*(piles >> colour & 1 for colour in range(NUM_COLOURS)), 1], dtype=bool)
+	for piles in range(1 << NUM_COLOURS)
+)
+for _mask in _DRAW_MASKS:
+	_mask.flags.writeable = False
+
+
+def _expand_masks(byte_table, masks):
+	""" byte_table entries for every bit of each 60-bit mask, 64 entries per mask """
+	packed = 0
+	for i, mask in enumerate(masks):
+		packed |= mask << (64 * i)
+	return b''.join([byte_table[byte] for byte in packed.to_bytes(8 * len(masks), 'little')])
+
+
+def _signs_to_bits(signs):
+	return sum(1 << int(card) for card in np.flatnonzero(signs > 0))
+
+
+def _playable_bits(stack):
+	""" Mask of every card that could legally go on top of the given stack mask """
+	return (
+		_SEGMENT_PLAYABLE[stack & COLOUR_BITS]
+		| _SEGMENT_PLAYABLE[stack >> 12 & COLOUR_BITS] << 12
+		| _SEGMENT_PLAYABLE[stack >> 24 & COLOUR_BITS] << 24
+		| _SEGMENT_PLAYABLE[stack >> 36 & COLOUR_BITS] << 36
+		| _SEGMENT_PLAYABLE[stack >> 48 & COLOUR_BITS] << 48
+	)
+
+
+class BitGameState:
+	__slots__ = [
+		'current_player', 'illegal_draw_pile', 'deck', 'deck_size',
+		'discard_piles', 'discard_lens', 'stacks', 'hands',
+	]
+
+	def __init__(self):
+		pass
+
+	def init_random_game(self):
+		self.current_player = 0
+		self.illegal_draw_pile = None
+
+		deck = list(range(60))
+		shuffle(deck)
+		self.deck = bytes(deck)
+		self.deck_size = 60 - 16
+
+		self.discard_piles = bytearray(NUM_COLOURS * 12)
+		self.discard_lens = bytearray(NUM_COLOURS)
+		self.stacks = (0, 0)
+		self.hands = (
+			sum(1 << card for card in self.deck[52:]),
+			sum(1 << card for card in self.deck[44:52]),
+		)
+
+
+	def clone(self):
+		other = BitGameState.__new__(BitGameState)
+		other.current_player = self.current_player
+		other.illegal_draw_pile = self.illegal_draw_pile
+		other.deck = self.deck
+		other.deck_size = self.deck_size
+		other.discard_piles = self.discard_piles[:]
+		other.discard_lens = self.discard_lens[:]
+		other.stacks = self.stacks
+		other.hands = self.hands
+		return other
+
+	def _key(self):
+		return (
+			self.hands, self.stacks, bytes(self.discard_piles), bytes(self.discard_lens),
+			self.deck[:self.deck_size], self.illegal_draw_pile, self.current_player,
+		)
+
+	def __hash__(self):
+		return hash(self._key())
+
+	def __eq__(self, other):
+		return isinstance(other, BitGameState) and self._key() == other._key()
+
+
+	def info_key(self, observer):
+		""" Hash of everything the given (absolute) player can see, i.e. all but the other
+		player's hand and the deck order """
+		hand = 0 if observer == self.current_player else 1
+		return hash((
+			self.hands[hand], self.stacks[hand], self.stacks[1 - hand],
+			bytes(self.discard_piles), bytes(self.discard_lens),
+			self.deck_size, self.illegal_draw_pile, hand,
+		))
+
+	@staticmethod
+	def from_features(features, opponent_hand, deck, illegal_draw_pile=None):
+		""" Rebuild the state seen by the player to move from their feature vector, filling
+		in the hidden cards with the given opponent hand and deck order """
+		card_features = features[:60 * 5].reshape((60, 5))
+		state = BitGameState.__new__(BitGameState)
+		state.current_player = 0
+		state.illegal_draw_pile = illegal_draw_pile
+		state.deck = bytes(deck)
+		state.deck_size = len(deck)
+		state.hands = (_signs_to_bits(card_features[:, 0]), sum(1 << int(card) for card in opponent_hand))
+		state.stacks = (_signs_to_bits(card_features[:, 1]), _signs_to_bits(card_features[:, 2]))
+
+		state.discard_piles = bytearray(NUM_COLOURS * 12)
+		state.discard_lens = bytearray(NUM_COLOURS)
+		in_discard = np.flatnonzero((card_features[:, 3] > 0) | (card_features[:, 4] > 0))
+		for card in in_discard[np.argsort(-card_features[in_discard, 4], kind='stable')]:
+			colour = _COLOURS[card]
+			state.discard_piles[12 * colour + state.discard_lens[colour]] = card
+			state.discard_lens[colour] += 1
+		return state
+
+	def to_bytes(self):
+		illegal = NO_PILE if self.illegal_draw_pile is None else self.illegal_draw_pile
+		return _STRUCT.pack(
+			*self.hands, *self.stacks, self.deck, bytes(self.discard_piles), bytes(self.discard_lens),
+			self.deck_size, illegal, self.current_player,
+		)
+
+	@staticmethod
+	def from_bytes(data):
+		state = BitGameState.__new__(BitGameState)
+		h0, h1, s0, s1, deck, piles, lens, deck_size, illegal, player = _STRUCT.unpack(data)
+		state.hands, state.stacks = (h0, h1), (s0, s1)
+		state.deck, state.deck_size = deck, deck_size
+		state.discard_piles, state.discard_lens = bytearray(piles), bytearray(lens)
+		state.illegal_draw_pile = None if illegal == NO_PILE else illegal
+		state.current_player = player
+		return state
+
+	def __getstate__(self):
+		return self.to_bytes()
+
+	def __setstate__(self, data):
+		other = BitGameState.from_bytes(data)
+		for name in BitGameState.__slots__:
+			setattr(self, name, getattr(other, name))
+
+
+	def swap_player(self):
+		self.stacks = (self.stacks[1], self.stacks[0])
+		self.hands = (self.hands[1], self.hands[0])
+		self.current_player = 1 - self.current_player
+
+
+	def do_play(self, card_index, is_discard):
+		card_index = int(card_index)
+		bit = 1 << card_index
+		if not self.hands[0] & bit:
+			raise ValueError("Tried to use card not in hand")
+		self.hands = (self.hands[0] & ~bit, self.hands[1])
+
+		colour = _COLOURS[card_index]
+		if is_discard:
+			self.discard_piles[12 * colour + self.discard_lens[colour]] = card_index
+			self.discard_lens[colour] += 1
+			self.illegal_draw_pile = colour
+		else:
+			self.stacks = (self.stacks[0] | bit, self.stacks[1])
+
+
+	def do_draw(self, choice):
+		choice = int(choice)
+		assert(choice != self.illegal_draw_pile)
+		self.illegal_draw_pile = None
+
+		if choice == DECK:
+			self.deck_size -= 1
+			new_card = self.deck[self.deck_size]
+		else:
+			if not self.discard_lens[choice]:
+				raise ValueError("Tried to draw from an empty discard pile")
+			self.discard_lens[choice] -= 1
+			slot = 12 * choice + self.discard_lens[choice]
+			new_card = self.discard_piles[slot]
+			self.discard_piles[slot] = 0  # keep unused slots zeroed so equal states hash equally
+
+		self.hands = (self.hands[0] | 1 << new_card, self.hands[1])
+		return new_card
+
+
+	def _get_features(self, out=None):
+		features = np.empty(60 * 5 + 1, dtype=np.float32) if out is None else out
+		card_features = features[:60 * 5].reshape((60, 5))
+		columns = _expand_masks(_BYTE_SIGN_BYTES, (self.hands[0], *self.stacks)) + _EMPTY_DISCARD_BYTES
+		card_features[:] = np.frombuffer(columns, dtype=np.float32).reshape((5, 64))[:, :60].T
+
+		piles = self.discard_piles
+		for colour in range(NUM_COLOURS):
+			length = self.discard_lens[colour]
+			if length:
+				start = 12 * colour
+				for covered, card in enumerate(reversed(piles[start:start + length])):
+					card_features[card, 4] = covered
+				card_features[piles[start + length - 1], 3] = 1
+
+		features[-1] = self.deck_size
+		return features
+
+
+	def _get_legal_play_mask(self):
+		""" Read-only (60, 2) mask. Any card in hand can be discarded """
+		hand = self.hands[0]
+		columns = _expand_masks(_BYTE_BOOL_BYTES, (hand & _playable_bits(self.stacks[0]), hand))
+		return np.frombuffer(columns, dtype=bool).reshape((2, 64))[:, :60].T
+
+
+	def get_legal_play_actions(self):
+		""" Legal plays as flat indices into the (60, 2) mask, i.e. 2 * card + is_discard """
+		hand = self.hands[0]
+		playable = hand & _playable_bits(self.stacks[0])
+		actions = []
+		while hand:
+			bit = hand & -hand
+			card = bit.bit_length() - 1
+			if playable & bit:
+				actions.append(2 * card)
+			actions.append(2 * card + 1)
+			hand ^= bit
+		return actions
+
+	def get_legal_draw_actions(self):
+		actions = [
+			colour for colour in range(NUM_COLOURS)
+			if self.discard_lens[colour] and colour != self.illegal_draw_pile
+		]
+		actions.append(DECK)
+		return actions
+
+
+	def _get_legal_draw_mask(self):
+		""" Read-only (6,) mask """
+		piles = 0
+		for colour in range(NUM_COLOURS):
+			if self.discard_lens[colour] and colour != self.illegal_draw_pile:
+				piles |= 1 << colour
+		return _DRAW_MASKS[piles]
+
+	def get_play_features(self, out=None):
+		return self._get_features(out), self._get_legal_play_mask()
+
+	def get_draw_features(self, out=None):
+		return self._get_features(out), self._get_legal_draw_mask()
+
+
+	def is_finished(self):
+		return self.deck_size == 0
+
+
+	def get_scores(self):
+		scores = np.empty(shape=(2, 5), dtype=np.int32)
+		for player in range(2):
+			for colour in range(NUM_COLOURS):
+				scores[player, colour] = _SEGMENT_SCORES[self.stacks[player] >> (12 * colour) & COLOUR_BITS]
+		return scores
+
+	def get_score_delta(self):
+		score = 0
+		for colour in range(NUM_COLOURS):
+			score += _SEGMENT_SCORES[self.stacks[0] >> (12 * colour) & COLOUR_BITS]
+			score -= _SEGMENT_SCORES[self.stacks[1] >> (12 * colour) & COLOUR_BITS]
+		return score
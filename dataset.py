@@ -0,0 +1,67 @@
+import numpy as np
+
+
+"""
+Compact encoding of training positions and targets.
+
+A position is 60x5 card features plus the deck count. The first four card columns are
+all +/-1 so they pack into 240 bits, the discard-depth column is a small count that
+fits a byte, and so does the deck count: 91 bytes instead of 1204.
+
+Targets from train.self_play_match are SENTINEL everywhere except the chosen action,
+so they are stored as an (action index, value) pair and only expanded back to dense
+rows for the training batch.
+"""
+
+SENTINEL = 9999
+
+BINARY_COLUMNS = 4
+PACKED_BITS_SIZE = 60 * BINARY_COLUMNS // 8
+PACKED_SIZE = PACKED_BITS_SIZE + 60 + 1
+
+
+def pack_features(features):
+	""" (n, 301) float32 features -> (n, PACKED_SIZE) uint8 """
+	features = np.asarray(features)
+	n = features.shape[0]
+	card_features = features[:, :60 * 5].reshape((n, 60, 5))
+
+	packed = np.empty((n, PACKED_SIZE), dtype=np.uint8)
+	packed[:, :PACKED_BITS_SIZE] = np.packbits((card_features[:, :, :BINARY_COLUMNS] > 0).reshape((n, -1)), axis=1)
+	packed[:, PACKED_BITS_SIZE:-1] = card_features[:, :, BINARY_COLUMNS]
+	packed[:, -1] = features[:, -1]
+	return packed
+
+
+def unpack_features(packed, out=None):
+	""" Inverse of pack_features """
+	n = packed.shape[0]
+	if out is None:
+		out = np.empty((n, 60 * 5 + 1), dtype=np.float32)
+	card_features = out[:, :60 * 5].reshape((n, 60, 5))
+
+	bits = np.unpackbits(packed[:, :PACKED_BITS_SIZE], axis=1).reshape((n, 60, BINARY_COLUMNS))
+	np.multiply(bits, 2, out=card_features[:, :, :BINARY_COLUMNS], casting='unsafe')
+	card_features[:, :, :BINARY_COLUMNS] -= 1
+	card_features[:, :, BINARY_COLUMNS] = packed[:, PACKED_BITS_SIZE:-1]
+	out[:, -1] = packed[:, -1]
+	return out
+
+
+def sparse_targets(targets):
+	""" Dense SENTINEL-filled target rows -> (action indices, values) """
+	actions = np.argmax(targets != SENTINEL, axis=1)
+	values = targets[np.arange(targets.shape[0]), actions]
+	return actions.astype(np.uint8), values.astype(np.int16)
+
+
+def target_pairs(actions, values):
+	""" (n, 2) float32 rows of (action index, value), as used by train.squared_error_sparse """
+	return np.stack((actions, values), axis=1).astype(np.float32)
+
+
+def dense_targets(actions, values, width):
+	""" Inverse of sparse_targets """
+	targets = np.full((actions.shape[0], width), SENTINEL, dtype=np.float32)
+	targets[np.arange(actions.shape[0]), actions] = values
+	return targets
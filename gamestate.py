@@ -38,20 +38,25 @@ NUM_COLOURS = 5
 DECK = 5
 
 
-class Card:
-	__slots__ = ['index', 'colour', 'value', 'label']
-	def __init__(self, index):
-		self.index = index
-		self.colour, self.value = Card.idx_to_colour_and_value(index)
-		self.label = 'X' if self.value == 0 else str(self.value)
+# Static card table. Cards are the integers 0..59, colour by colour, each colour being
+# three handshakes (value 0, label 'X') then 2..10. Hands, stacks, piles and the deck all
+# hold plain indices, and anything else about a card is looked up here
+CARD_COLOURS = np.repeat(np.arange(NUM_COLOURS), 12)
+CARD_VALUES = np.tile(np.array([0, 0, 0, *range(2, 11)]), NUM_COLOURS)
+CARD_IS_HANDSHAKE = CARD_VALUES == 0
+CARD_LABELS = np.where(CARD_IS_HANDSHAKE, 'X', CARD_VALUES.astype(str))
+for _table in (CARD_COLOURS, CARD_VALUES, CARD_IS_HANDSHAKE, CARD_LABELS):
+	_table.flags.writeable = False
 
-	def __repr__(self):
-		return f'({self.colour}, {self.label})'
+# Tuple copies for scalar lookups in the move code, where indexing NumPy is slow
+_colours = tuple(CARD_COLOURS.tolist())
+_values = tuple(CARD_VALUES.tolist())
 
-	def idx_to_colour_and_value(idx):
-		colour, r = divmod(idx, 12)
-		val = 0 if r < 3 else r - 1
-		return colour, val
+
+PLAY_MOVE, DRAW_MOVE, SWAP_MOVE = range(3)
+
+# Columns of the (60, 5) card feature matrix
+HAND_FEATURE, MY_STACK_FEATURE, OPPONENT_STACK_FEATURE, DISCARD_TOP_FEATURE, DISCARD_COVERED_FEATURE = range(5)
 
 
 class GameState:
@@ -63,128 +68,269 @@ class GameState:
 		self.current_player = 0
 		self.illegal_draw_pile = None  # If you just played to a pile
 	
-		self.deck = [Card(i) for i in range(60)]
+		self.deck = list(range(60))
 		shuffle(self.deck)
 
+		# Persistent feature vectors, updated in place and handed out as read-only views. Each
+		# player's point of view is one row of a single backing matrix, and every move keeps
+		# both rows up to date, so a swap only flips which row is exposed. The feature
+		# vectors can't be column permutations of one shared matrix, since the networks need
+		# each one contiguous in the same column order
+		features = np.empty((2, 60 * 5 + 1), dtype=np.float32)
+		card_features = features[:, :60 * 5].reshape((2, 60, 5))
+		card_features[:, :, :DISCARD_COVERED_FEATURE] = -1
+		card_features[:, :, DISCARD_COVERED_FEATURE] = 0
+		self.feature_rows = tuple(features)
+		# Current player first, like hands and stacks
+		self.card_features = tuple(card_features)
+		self.features_views = tuple(features)
+		for view in self.features_views:
+			view.flags.writeable = False
+
 		self.discard_piles = defaultdict(list)
-		self.discard_top_features = np.ones(60, dtype=np.float32) * -1
-		self.discard_covered_features = np.zeros(60, dtype=np.float32)
+		# Piles pushed or popped since features were last built. Only their covered counts
+		# are rewritten then, so a discard or pile draw touches a constant number of entries
+		self.dirty_piles = set()
 		self.stacks = (defaultdict(list), defaultdict(list))
-		self.stack_features = [np.ones(60, dtype=np.float32) * -1 for _ in range(2)]
+		# Running [value total, handshakes, length, score] for every stack, and score totals
+		self.stack_stats = tuple([[0, 0, 0, 0] for _ in range(NUM_COLOURS)] for _ in range(2))
+		self.score_totals = [0, 0]
 
 		self.hands = ([], [])
-		self.hand_features = [np.ones(60, dtype=np.float32) * -1 for _ in range(2)]
-		for hand, features in zip(self.hands, self.hand_features):
+		for hand, card_features in zip(self.hands, self.card_features):
 			for _ in range(8):
 				card = self.deck.pop()
 				hand.append(card)
-				features[card.index] = 1
+				card_features[card, HAND_FEATURE] = 1
+		self._update_deck_size()
+
+		# Legal move masks, kept up to date by every move and handed out as read-only views.
+		# A play mask only depends on its player's own hand and stacks, so each player keeps
+		# one, current player first, and a swap exchanges them
+		play_masks = np.zeros(shape=(2, 60, 2), dtype=bool)
+		for hand, play_mask in zip(self.hands, play_masks):
+			play_mask[hand] = True  # stacks start empty and any card can be discarded
+		self.play_masks = tuple(play_masks)
+		self.play_mask_views = tuple(play_masks)
+		for view in self.play_mask_views:
+			view.flags.writeable = False
+		self.draw_mask = np.zeros(6, dtype=bool)
+		self.draw_mask[DECK] = True
+		self.draw_mask_view = self.draw_mask.view()
+		self.draw_mask_view.flags.writeable = False
+
+		# Enough about every move to take it back with undo()
+		self.move_log = []
+
+
+	def _can_stack(self, card):
+		stack = self.stacks[0][_colours[card]]
+		return not stack or _values[stack[-1]] <= _values[card]
+
+
+	def _set_shared_feature(self, card, column, value):
+		""" Set a feature both players see alike, in both points of view """
+		self.card_features[0][card, column] = value
+		self.card_features[1][card, column] = value
+
+	def _update_deck_size(self):
+		rows = self.feature_rows
+		rows[0][-1] = rows[1][-1] = len(self.deck)
+
+
+	def _update_stack_stats(self, card, sign):
+		stats = self.stack_stats[0][_colours[card]]
+		stats[0] += sign * _values[card]
+		stats[1] += sign * (_values[card] == 0)
+		stats[2] += sign
+		score = stack_score(*stats[:3])
+		self.score_totals[0] += score - stats[3]
+		stats[3] = score
 
 
 	def swap_player(self):
+		self.move_log.append((SWAP_MOVE,))
+		self._swap()
+
+	def _swap(self):
 		self.stacks = (self.stacks[1], self.stacks[0])
-		self.stack_features = (self.stack_features[1], self.stack_features[0])
 		self.hands = (self.hands[1], self.hands[0])
-		self.hand_features = (self.hand_features[1], self.hand_features[0])
+		self.card_features = (self.card_features[1], self.card_features[0])
+		self.features_views = (self.features_views[1], self.features_views[0])
+		self.play_masks = (self.play_masks[1], self.play_masks[0])
+		self.play_mask_views = (self.play_mask_views[1], self.play_mask_views[0])
+		self.stack_stats = (self.stack_stats[1], self.stack_stats[0])
+		self.score_totals.reverse()
 		self.current_player = 1 - self.current_player;
 
 
 	def do_play(self, card_index, is_discard):
-		card = None
-		for i, c in enumerate(self.hands[0]):
-			if c.index == card_index:
-				card = c
-				self.hands[0][i] = None
-				self.hand_features[0][card.index] = -1
-				break
-		else:
-			raise ValueError("Tried to use card not in hand")
-
+		card = int(card_index)
+		try:
+			i = self.hands[0].index(card)
+		except ValueError:
+			raise ValueError("Tried to use card not in hand") from None
+		self.hands[0][i] = None
+		self.card_features[0][card, HAND_FEATURE] = -1
+		self.play_masks[0][card] = False
+		self.move_log.append((PLAY_MOVE, card, i, is_discard, self.illegal_draw_pile))
+
+		colour = _colours[card]
 		if is_discard:
-			pile = self.discard_piles[card.colour]
-			self.illegal_draw_pile = card.colour
-			for prev_discard in pile:
-				self.discard_covered_features[prev_discard.index] += 1
+			pile = self.discard_piles[colour]
+			self.illegal_draw_pile = colour
 			if pile:
-				self.discard_top_features[pile[-1].index] = -1
+				self._set_shared_feature(pile[-1], DISCARD_TOP_FEATURE, -1)
+			self.dirty_piles.add(colour)
 			pile.append(card)
-			self.discard_top_features[card.index] = 1
+			self._set_shared_feature(card, DISCARD_TOP_FEATURE, 1)
+			self.draw_mask[colour] = False  # can't draw straight back
+
 
 		else:
-			self.stacks[0][card.colour].append(card)
-			self.stack_features[0][card.index] = 1
+			self.stacks[0][colour].append(card)
+			self.card_features[0][card, MY_STACK_FEATURE] = 1
+			self.card_features[1][card, OPPONENT_STACK_FEATURE] = 1
+			for other in self.hands[0]:
+				if other is not None and _colours[other] == colour:
+					self.play_masks[0][other, 0] = _values[other] >= _values[card]
+			self._update_stack_stats(card, 1)
 
 
 	def do_draw(self, choice):
 		assert(choice != self.illegal_draw_pile)
+		prev_illegal_draw_pile = self.illegal_draw_pile
+		if self.illegal_draw_pile is not None:
+			self.draw_mask[self.illegal_draw_pile] = True
 		self.illegal_draw_pile = None
 
 		if choice == DECK:
 			new_card = self.deck.pop()
+			self._update_deck_size()
 		else:
 			pile = self.discard_piles[choice]
 			new_card = pile.pop()
-			self.discard_top_features[new_card.index] = -1
+			self._set_shared_feature(new_card, DISCARD_TOP_FEATURE, -1)
+			self._set_shared_feature(new_card, DISCARD_COVERED_FEATURE, 0)
+			self.dirty_piles.add(choice)
 
-			for prev_discard in pile:
-				self.discard_covered_features[prev_discard.index] -= 1
 			if pile:
-				self.discard_top_features[pile[-1].index] = 1
+				self._set_shared_feature(pile[-1], DISCARD_TOP_FEATURE, 1)
+			else:
+				self.draw_mask[choice] = False
 
 		for i, c in enumerate(self.hands[0]):
 			if c is None:
 				self.hands[0][i] = new_card
-				self.hand_features[0][new_card.index] = 1
+				self.card_features[0][new_card, HAND_FEATURE] = 1
+				self.play_masks[0][new_card, 0] = self._can_stack(new_card)
+				self.play_masks[0][new_card, 1] = True
+				self.move_log.append((DRAW_MOVE, new_card, i, choice, prev_illegal_draw_pile))
 				return new_card
 
 		raise ValueError("No free slot in hand for new card")
 
 
-	def _get_features(self):
-		features = np.empty(60 * 5 + 1, dtype = np.float32)
-		np.concatenate(
-			(
-				self.hand_features[0][:, None],
-				self.stack_features[0][:, None],
-				self.stack_features[1][:, None],
-				self.discard_top_features[:, None],
-				self.discard_covered_features[:, None],
-			),
-			axis=-1,
-			out=features[:60*5].reshape((60, 5)),
-		).flatten()
-		features [-1] = len(self.deck)
-		return features
-
-
-	def _get_legal_play_mask(self):
-		mask = np.zeros(shape=(60, 2), dtype=bool)
+	def undo(self):
+		""" Take back the last do_play, do_draw or swap_player """
+		move, *details = self.move_log.pop()
+
+		if move == SWAP_MOVE:
+			self._swap()
+
+		elif move == PLAY_MOVE:
+			card, slot, is_discard, prev_illegal_draw_pile = details
+			colour = _colours[card]
+			if is_discard:
+				pile = self.discard_piles[colour]
+				pile.pop()
+				self._set_shared_feature(card, DISCARD_TOP_FEATURE, -1)
+				self._set_shared_feature(card, DISCARD_COVERED_FEATURE, 0)
+				self.dirty_piles.add(colour)
+				if pile:
+					self._set_shared_feature(pile[-1], DISCARD_TOP_FEATURE, 1)
+				self.draw_mask[colour] = bool(pile)
+			else:
+				self.stacks[0][colour].pop()
+				self.card_features[0][card, MY_STACK_FEATURE] = -1
+				self.card_features[1][card, OPPONENT_STACK_FEATURE] = -1
+				self._update_stack_stats(card, -1)
+				for other in self.hands[0]:
+					if other is not None and _colours[other] == colour:
+						self.play_masks[0][other, 0] = self._can_stack(other)
+
+			self.illegal_draw_pile = prev_illegal_draw_pile
+			if prev_illegal_draw_pile is not None:
+				self.draw_mask[prev_illegal_draw_pile] = False
+			self.hands[0][slot] = card
+			self.card_features[0][card, HAND_FEATURE] = 1
+			self.play_masks[0][card, 0] = self._can_stack(card)
+			self.play_masks[0][card, 1] = True
 
-		for card in self.hands[0]:
-			if card is None:
-				continue
-			stack = self.stacks[0][card.colour]
-			mask[card.index, 0] = not stack or stack[-1].value <= card.value
-			mask[card.index, 1] = 1  # can always discard from hand
+		else:
+			card, slot, choice, prev_illegal_draw_pile = details
+			self.hands[0][slot] = None
+			self.card_features[0][card, HAND_FEATURE] = -1
+			self.play_masks[0][card] = False
+
+			if choice == DECK:
+				self.deck.append(card)
+				self._update_deck_size()
+			else:
+				pile = self.discard_piles[choice]
+				if pile:
+					self._set_shared_feature(pile[-1], DISCARD_TOP_FEATURE, -1)
+				self.dirty_piles.add(choice)
+				pile.append(card)
+				self._set_shared_feature(card, DISCARD_TOP_FEATURE, 1)
+				self.draw_mask[choice] = True
+
+			self.illegal_draw_pile = prev_illegal_draw_pile
+			if prev_illegal_draw_pile is not None:
+				self.draw_mask[prev_illegal_draw_pile] = False
+
+
+	def _get_features(self, out=None):
+		""" Read-only view of the current features, which later moves will change.
+		Pass `out` to get a copy in a caller-owned buffer instead """
+		if self.dirty_piles:
+			mine, theirs = self.card_features
+			for colour in self.dirty_piles:
+				pile = self.discard_piles[colour]
+				for covered, card in enumerate(reversed(pile)):
+					mine[card, DISCARD_COVERED_FEATURE] = theirs[card, DISCARD_COVERED_FEATURE] = covered
+			self.dirty_piles.clear()
+
+		if out is None:
+			return self.features_views[0]
+		out[:] = self.features_views[0]
+		return out
 
-		return mask
 
+	def _get_legal_play_mask(self):
+		return self.play_mask_views[0]
 
 	def _get_legal_draw_mask(self):
-		mask = np.ones(6, dtype=bool)
+		return self.draw_mask_view
 
-		if self.illegal_draw_pile is not None:
-			mask[self.illegal_draw_pile] = False
-		for colour in range(NUM_COLOURS):
-			if len(self.discard_piles[colour]) == 0:
-				mask[colour] = False
-		return mask
+	def get_legal_play_actions(self):
+		""" Legal plays as flat indices into the (60, 2) mask, i.e. 2 * card + is_discard """
+		actions = []
+		for card in self.hands[0]:
+			if card is not None:
+				if self.play_masks[0][card, 0]:
+					actions.append(2 * card)
+				actions.append(2 * card + 1)
+		return np.array(actions)
+
+	def get_legal_draw_actions(self):
+		return np.flatnonzero(self.draw_mask)
 
-	def get_play_features(self):
-		return self._get_features(), self._get_legal_play_mask()
+	def get_play_features(self, out=None):
+		return self._get_features(out), self._get_legal_play_mask()
 
-	def get_draw_features(self):
-		return self._get_features(), self._get_legal_draw_mask()
+	def get_draw_features(self, out=None):
+		return self._get_features(out), self._get_legal_draw_mask()
 
 
 	def is_finished(self):
@@ -192,26 +338,33 @@ class GameState:
 
 
 	def get_scores(self):
-		scores = np.empty(shape=(2, 5), dtype=np.int32)
-		for player in range(2):
-			for colour in range(NUM_COLOURS):
-				scores[player, colour] = score_stack(self.stacks[player][colour])
-		return scores
+		return np.array([[stats[3] for stats in player] for player in self.stack_stats], dtype=np.int32)
 
 	def get_score_delta(self):
-		score = 0
-		for colour in range(NUM_COLOURS):
-			 score += score_stack(self.stacks[0][colour])
-			 score -= score_stack(self.stacks[1][colour])
-		return score
+		return self.score_totals[0] - self.score_totals[1]
+
+	def _check_scores(self):
+		""" Compare the incrementally tracked scores against scoring every stack from scratch """
+		for player in range(2):
+			expected = [score_stack(self.stacks[player][colour]) for colour in range(NUM_COLOURS)]
+			assert [stats[3] for stats in self.stack_stats[player]] == expected
+			assert self.score_totals[player] == sum(expected)
+
+
+def stack_score(value_total, handshakes, length):
+	""" Score of a stack given its running statistics """
+	if not length:
+		return 0
+	return (value_total - 20) * (1 + handshakes) + 20 * (length >= 8)
 
 
 def score_stack(stack):
+	""" Score of a stack given as a list of card indices """
 	if not stack:
 		return 0
-	score = sum(card.value for card in stack)
+	score = sum(_values[card] for card in stack)
 	score -= 20
-	score *= 1 + sum(card.value == 0 for card in stack[:3])
+	score *= 1 + sum(_values[card] == 0 for card in stack[:3])
 	score += 20 * (len(stack) >= 8)
 	return score
 
@@ -0,0 +1,206 @@
+from math import log, sqrt, tanh
+import random
+import time
+
+import numpy as np
+
+from agent import Agent
+from bitstate import BitGameState
+
+
+"""
+Determinized Monte Carlo tree search.
+
+Every simulation deals the cards the searching player can't see (the opponent's hand
+and the deck order) at random, then walks down a tree shared by all deals. Tree nodes
+live in a transposition table keyed on BitGameState.info_key, i.e. on what the
+searching player knows, so different deals of the same information set and different
+move orders reaching the same position share statistics. Since the opponent's legal
+moves change from deal to deal, each edge also counts how often it was available and
+UCB uses that instead of the parent visit count (single-observer ISMCTS).
+
+Leaves are scored by a random rollout to the end of the game, or, given a value_agent
+(a DenseAgent), by the best predicted score delta from its networks. Network leaves
+are collected leaf_batch_size at a time, using virtual loss to spread the batch out,
+and evaluated in one forward pass per network.
+
+Values are tanh(score delta / value_scale) from the searching player's point of view.
+"""
+
+PLAY_PHASE, DRAW_PHASE = 0, 1
+
+
+class Node:
+	__slots__ = ['edges']
+
+	def __init__(self):
+		self.edges = {}  # action -> [visits, total value, times available]
+
+
+class MCTSAgent(Agent):
+
+	def __init__(
+		self, num_simulations=1000, time_limit=None, exploration=1.0, value_agent=None,
+		leaf_batch_size=16, value_scale=30.0, max_table_size=1_000_000, rng=None,
+	):
+		self.num_simulations = num_simulations
+		self.time_limit = time_limit
+		self.exploration = exploration
+		self.value_agent = value_agent
+		self.leaf_batch_size = leaf_batch_size if value_agent is not None else 1
+		self.value_scale = value_scale
+		self.max_table_size = max_table_size
+		self.rng = random.Random() if rng is None else rng
+		self.table = {}
+		self.simulations_run = 0
+
+	def pick_play(self, state, mask):
+		choice = self.search(state, mask, PLAY_PHASE)
+		return divmod(choice, 2)
+
+	def pick_draw(self, state, mask):
+		return self.search(state, mask, DRAW_PHASE)
+
+
+	def _determinize(self, features, unseen, illegal_draw_pile):
+		self.rng.shuffle(unseen)
+		return BitGameState.from_features(features, unseen[:8], unseen[8:], illegal_draw_pile)
+
+	def search(self, features, mask, phase):
+		features = np.asarray(features)
+		legal = np.flatnonzero(mask)
+		if legal.size == 1:
+			return legal[0]
+
+		card_features = features[:60 * 5].reshape((60, 5))
+		unseen = np.flatnonzero(np.all(card_features[:, :4] < 0, axis=1) & (card_features[:, 4] == 0)).tolist()
+		illegal_draw_pile = None
+		if phase == DRAW_PHASE:
+			pile_tops = np.flatnonzero(card_features[:, 3] > 0) // 12
+			illegal = [colour for colour in pile_tops if not mask[colour]]
+			illegal_draw_pile = int(illegal[0]) if illegal else None
+
+		if len(self.table) > self.max_table_size:
+			self.table.clear()
+
+		deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+		simulations = 0
+		while simulations < self.num_simulations:
+			if deadline is not None and time.perf_counter() > deadline:
+				break
+			leaves = []
+			for _ in range(self.leaf_batch_size):
+				root = self._determinize(features, unseen, illegal_draw_pile)
+				leaves.append(self._select(root, phase))
+			self._evaluate_and_backup(leaves)
+			simulations += len(leaves)
+		self.simulations_run += simulations
+
+		root = self._determinize(features, unseen, illegal_draw_pile)
+		node = self.table.get(root.info_key(0) * 2 + phase)
+		if node is None:
+			return legal[0]
+		return max(legal, key=lambda action: node.edges.get(action, (0,))[0])
+
+
+	def _legal_actions(self, state, phase):
+		if phase == PLAY_PHASE:
+			return state.get_legal_play_actions()
+		return state.get_legal_draw_actions()
+
+	def _apply(self, state, action, phase):
+		""" Play action and return the phase to move next, or None if the game is over """
+		if phase == PLAY_PHASE:
+			state.do_play(action >> 1, action & 1)
+			return DRAW_PHASE
+		state.do_draw(action)
+		if state.is_finished():
+			return None
+		state.swap_player()
+		return PLAY_PHASE
+
+	def _select(self, state, phase):
+		""" Walk down from the root with UCB, expanding one new edge. Returns the path of
+		edges taken with virtual loss applied, and the leaf state still to be valued """
+		path = []
+		while phase is not None:
+			key = state.info_key(0) * 2 + phase
+			node = self.table.get(key)
+			if node is None:
+				node = self.table[key] = Node()
+
+			actions = self._legal_actions(state, phase)
+			sign = 1 if state.current_player == 0 else -1
+			untried = []
+			for action in actions:
+				edge = node.edges.get(action)
+				if edge is None:
+					edge = node.edges[action] = [0, 0.0, 0]
+				edge[2] += 1
+				if edge[0] == 0:
+					untried.append(action)
+
+			if untried:
+				action = self.rng.choice(untried)
+			else:
+				c = self.exploration
+				action = max(actions, key=lambda a: (
+					sign * node.edges[a][1] / node.edges[a][0] + c * sqrt(log(node.edges[a][2]) / node.edges[a][0])
+				))
+
+			edge = node.edges[action]
+			edge[0] += 1
+			edge[1] -= sign  # virtual loss, undone in backup
+			path.append((edge, sign))
+			phase = self._apply(state, action, phase)
+			if untried:
+				break
+
+		return path, state, phase
+
+	def _evaluate_and_backup(self, leaves):
+		values = [None] * len(leaves)
+		network_leaves = []
+		for i, (path, state, phase) in enumerate(leaves):
+			if phase is None:
+				values[i] = self._score(state)
+			elif self.value_agent is None:
+				values[i] = self._rollout(state, phase)
+			else:
+				network_leaves.append(i)
+
+		if network_leaves:
+			for phase, evaluate in ((PLAY_PHASE, self.value_agent.play_values), (DRAW_PHASE, self.value_agent.draw_values)):
+				batch = [i for i in network_leaves if leaves[i][2] == phase]
+				if not batch:
+					continue
+				feats, masks = zip(*(
+					leaves[i][1].get_play_features() if phase == PLAY_PHASE else leaves[i][1].get_draw_features()
+					for i in batch
+				))
+				masks = np.reshape(masks, (len(batch), -1))
+				predictions = evaluate(np.stack(feats))
+				best = np.max(np.where(masks, predictions, -np.inf), axis=1)
+				for i, delta in zip(batch, best):
+					sign = 1 if leaves[i][1].current_player == 0 else -1
+					values[i] = tanh(sign * delta / self.value_scale)
+
+		for (path, state, phase), value in zip(leaves, values):
+			for edge, sign in path:
+				edge[1] += sign + value
+
+	def _score(self, state):
+		delta = state.get_score_delta()
+		if state.current_player != 0:
+			delta = -delta
+		return tanh(delta / self.value_scale)
+
+	def _rollout(self, state, phase):
+		choice = self.rng.choice
+		while phase is not None:
+			if phase == PLAY_PHASE:
+				action = choice(state.get_legal_play_actions())
+			else:
+				action = choice(state.get_legal_draw_actions())
+			phase = self._apply(state, action, phase)
+		return self._score(state)
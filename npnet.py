@@ -0,0 +1,314 @@
+import time
+
+import numpy as np
+
+from gamestate import DISCARD_COVERED_FEATURE
+
+
+"""
+Pure NumPy forward pass for the dense play/draw networks built in agent.py.
+
+At play time a Keras model call costs far more in framework overhead than the few
+matmuls it wraps, so the weights are exported once and run here instead, writing into
+activation buffers that are allocated once and only grow when a bigger batch arrives.
+"""
+
+
+class NumpyDenseNetwork:
+
+	def __init__(self, weights, biases, relu):
+		self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+		self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+		self.relu = list(relu)
+		self.buffers = []
+		self._allocate(1)
+
+	@staticmethod
+	def from_keras(model):
+		""" Copy the weights of a model made of a chain of Dense layers (relu or linear),
+		either Sequential or functional, e.g. one head of a shared-trunk model """
+		if len(model.inputs) != 1 or len(model.outputs) != 1:
+			raise ValueError(f"Expected a single-input, single-output model, {model.name} has "
+				f"{len(model.inputs)} inputs and {len(model.outputs)} outputs")
+		weights, biases, relu = [], [], []
+		for layer in model.layers:
+			if not layer.weights:
+				continue
+			activation = layer.get_config()['activation']
+			if activation not in ('relu', 'linear'):
+				raise ValueError(f"Unsupported activation '{activation}' in layer {layer.name}")
+			w, b = layer.get_weights()
+			weights.append(w)
+			biases.append(b)
+			relu.append(activation == 'relu')
+		return NumpyDenseNetwork(weights, biases, relu)
+
+	def save(self, path):
+		arrays = {}
+		for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+			arrays[f'w{i}'], arrays[f'b{i}'] = w, b
+		np.savez(path, relu=np.array(self.relu), **arrays)
+
+	@staticmethod
+	def load(path):
+		with np.load(path) as f:
+			num_layers = len(f['relu'])
+			weights = [f[f'w{i}'] for i in range(num_layers)]
+			biases = [f[f'b{i}'] for i in range(num_layers)]
+			return NumpyDenseNetwork(weights, biases, f['relu'])
+
+
+	def _allocate(self, batch_size):
+		self.buffers = [np.empty((batch_size, w.shape[1]), dtype=np.float32) for w in self.weights]
+
+	def __call__(self, x):
+		""" Forward pass of a (batch, inputs) or (inputs,) array. The result is a view of an
+		internal buffer, only valid until the next call """
+		x = np.asarray(x, dtype=np.float32)
+		if x.ndim == 1:
+			x = x[None, :]
+		n = x.shape[0]
+		if n > self.buffers[0].shape[0]:
+			self._allocate(max(n, 2 * self.buffers[0].shape[0]))
+
+		for w, b, relu, buffer in zip(self.weights, self.biases, self.relu, self.buffers):
+			out = buffer[:n]
+			np.matmul(x, w, out=out)
+			out += b
+			if relu:
+				np.maximum(out, 0, out=out)
+			x = out
+		return x
+
+
+# Largest magnitude of any input feature: the deck count at the start of a game
+MAX_FEATURE = 60 - 2 * 8
+
+
+class QuantizedDenseNetwork:
+	""" Simulated post-training int8 quantization of a NumpyDenseNetwork, for measuring
+	how much accuracy int8 inference would cost (see quantization_report). It is not a
+	faster path: NumPy has no int8 GEMM, its integer matmul is 10-60x slower than float32
+	BLAS here, so the products still run in float32.
+
+	Weights are rounded to int8 codes per output unit and kept only as exactly
+	representable float32 codes. Hidden activations are rounded to int8 codes per row on
+	the fly. The input features are already small integers (+1 / -1 card features,
+	covered counts up to 11, the deck count up to 44), so the first layer takes them as
+	they are: the count columns don't set the scale of the +1 / -1 ones. Every product of
+	codes is exact in float32 since a layer's sums stay below 2^24, so the outputs match
+	what an int8 x int8 -> int32 kernel would compute """
+
+	def __init__(self, weights, weight_scales, biases, relu):
+		self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+		self.weight_scales = [np.asarray(s, dtype=np.float32) for s in weight_scales]
+		self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+		self.relu = list(relu)
+		for w in self.weights:
+			if np.max(np.abs(w)) > 127 or np.any(w != np.round(w)):
+				raise ValueError("Weights must be int8 codes in [-127, 127]")
+		for i, w in enumerate(self.weights):
+			max_input = MAX_FEATURE if i == 0 else 127
+			if w.shape[0] * max_input * 127 >= 2 ** 24:
+				raise ValueError(f"Layer with {w.shape[0]} inputs is too wide for exact float32 accumulation")
+
+	@staticmethod
+	def from_network(network):
+		weights, weight_scales = [], []
+		for w in network.weights:
+			scale = np.maximum(np.max(np.abs(w), axis=0), 1e-12) / 127
+			weights.append(np.round(w / scale))
+			weight_scales.append(scale)
+		return QuantizedDenseNetwork(weights, weight_scales, network.biases, network.relu)
+
+	def save(self, path):
+		arrays = {}
+		for i, (w, s, b) in enumerate(zip(self.weights, self.weight_scales, self.biases)):
+			arrays[f'w{i}'], arrays[f's{i}'], arrays[f'b{i}'] = w.astype(np.int8), s, b
+		np.savez(path, relu=np.array(self.relu), **arrays)
+
+	@staticmethod
+	def load(path):
+		with np.load(path) as f:
+			num_layers = len(f['relu'])
+			return QuantizedDenseNetwork(
+				[f[f'w{i}'] for i in range(num_layers)],
+				[f[f's{i}'] for i in range(num_layers)],
+				[f[f'b{i}'] for i in range(num_layers)],
+				f['relu'],
+			)
+
+
+	def __call__(self, x):
+		x = np.asarray(x, dtype=np.float32)
+		if x.ndim == 1:
+			x = x[None, :]
+
+		for i, (w, w_scale, b, relu) in enumerate(zip(self.weights, self.weight_scales, self.biases, self.relu)):
+			if i == 0:
+				# Integer features are their own codes
+				x = x @ w
+			else:
+				x_scale = np.maximum(np.max(np.abs(x), axis=1, keepdims=True), 1e-12) / 127
+				x = np.round(x / x_scale) @ w
+				x *= x_scale
+			x *= w_scale
+			x += b
+			if relu:
+				np.maximum(x, 0, out=x)
+		return x
+
+
+# Features of a position with nothing in it: every card absent from every zone, no
+# covered discards and an empty deck. Real positions differ from it in a few dozen places
+EMPTY_FEATURES = np.zeros(60 * 5 + 1, dtype=np.float32)
+EMPTY_FEATURES[:60 * 5].reshape((60, 5))[:, :DISCARD_COVERED_FEATURE] = -1
+
+
+def sparse_features(features):
+	""" (n, 301) or (301,) features -> the entries that differ from EMPTY_FEATURES, as
+	flat (feature indices, differences) plus the (n + 1) offsets where each row starts """
+	features = np.asarray(features, dtype=np.float32)
+	if features.ndim == 1:
+		features = features[None, :]
+	delta = features - EMPTY_FEATURES
+	rows, indices = np.nonzero(delta)
+	row_starts = np.searchsorted(rows, np.arange(features.shape[0] + 1))
+	return indices, delta[rows, indices], row_starts
+
+
+class SparseInputNetwork:
+	""" A NumpyDenseNetwork whose first layer is an embedding bag over active (card, zone)
+	features instead of a 301-wide matmul.
+
+	Since x @ W + b = (x - EMPTY) @ W + (EMPTY @ W + b), the first layer is a folded bias
+	plus the weight rows of the few features that differ from an empty position, each
+	scaled by the difference. The result is the same function, at the cost of about 35
+	rather than 301 rows of W per position """
+
+	def __init__(self, network):
+		self.first_weights = network.weights[0]
+		self.first_bias = EMPTY_FEATURES @ network.weights[0] + network.biases[0]
+		self.first_relu = network.relu[0]
+		self.rest = None
+		if len(network.weights) > 1:
+			self.rest = NumpyDenseNetwork(network.weights[1:], network.biases[1:], network.relu[1:])
+
+	def __call__(self, x):
+		""" Forward pass of dense features, see from_sparse """
+		return self.from_sparse(*sparse_features(x))
+
+	def from_sparse(self, indices, values, row_starts):
+		""" Forward pass of positions in sparse_features form. The result is a view of an
+		internal buffer, only valid until the next call """
+		n = row_starts.shape[0] - 1
+		x = np.empty((n, self.first_weights.shape[1]), dtype=np.float32)
+
+		# One small gather and vector-matrix product per position. Broadcast multiplies and
+		# reduceat over the whole batch's gathered rows are far slower than this in NumPy
+		for row in range(n):
+			start, stop = row_starts[row], row_starts[row + 1]
+			np.matmul(values[start:stop], self.first_weights[indices[start:stop]], out=x[row])
+
+		x += self.first_bias
+		if self.first_relu:
+			np.maximum(x, 0, out=x)
+		return x if self.rest is None else self.rest(x)
+
+
+def quantization_report(reference, quantized, inputs, masks=None):
+	""" How far a quantized network's outputs drift from the float network on a set of
+	inputs, and how often the best (legal, if masks are given) action still agrees """
+	expected = np.array(reference(inputs))
+	actual = np.array(quantized(inputs))
+	error = np.abs(actual - expected)
+
+	if masks is not None:
+		masks = masks.reshape(expected.shape)
+		expected = np.where(masks, expected, -np.inf)
+		actual = np.where(masks, actual, -np.inf)
+
+	return {
+		'positions': int(inputs.shape[0]),
+		'max_abs_error': float(np.max(error)),
+		'mean_abs_error': float(np.mean(error)),
+		'output_std': float(np.std(reference(inputs))),
+		'argmax_agreement': float(np.mean(np.argmax(expected, axis=1) == np.argmax(actual, axis=1))),
+	}
+
+
+def _time_per_position(f, x, min_seconds=1.0):
+	f(x)
+	calls, start = 0, time.perf_counter()
+	while time.perf_counter() - start < min_seconds:
+		f(x)
+		calls += 1
+	return (time.perf_counter() - start) / calls / x.shape[0] * 1e6
+
+
+def sparse_input_report(network, inputs, batch_sizes=(1, 32, 256)):
+	""" Multiply-adds and measured latency per position of the first layer and the whole
+	network, dense against SparseInputNetwork (including the conversion from dense features) """
+	sparse = SparseInputNetwork(network)
+	first_dense = NumpyDenseNetwork(network.weights[:1], network.biases[:1], network.relu[:1])
+	first_sparse = SparseInputNetwork(first_dense)
+	active = sparse_features(inputs)[0].size / inputs.shape[0]
+	units = network.weights[0].shape[1]
+	later_macs = sum(w.size for w in network.weights[1:])
+
+	report = {
+		'active_features': active,
+		'first_layer_macs': {'dense': network.weights[0].size, 'sparse': active * units},
+		'network_macs': {'dense': network.weights[0].size + later_macs, 'sparse': active * units + later_macs},
+		'max_abs_error': float(np.max(np.abs(network(inputs[:2048]) - sparse(inputs[:2048])))),
+	}
+	for n in batch_sizes:
+		x = inputs[:n]
+		report[f'batch_{n}_us'] = {
+			'first_layer_dense': _time_per_position(first_dense, x),
+			'first_layer_sparse': _time_per_position(first_sparse, x),
+			'network_dense': _time_per_position(network, x),
+			'network_sparse': _time_per_position(sparse, x),
+		}
+	return report
+
+
+if __name__ == '__main__':
+	# Quantization drift and sparse-input benchmark on held-out self-play positions
+	import json
+	import sys
+
+	from agent import DenseAgent, QuantizedDenseAgent, RandomAgent
+	from batchedstate import BatchedGameState
+
+	agent = QuantizedDenseAgent(existing_agent=DenseAgent())
+	random_agent = RandomAgent()
+	state = BatchedGameState(200)
+	state.init_random_games(np.random.default_rng(0))
+	play_feats, play_masks, draw_feats, draw_masks = [], [], [], []
+	for _ in range(150):
+		active = np.flatnonzero(~state.is_finished())
+		if active.size == 0:
+			break
+		feats, masks = state.get_play_features(active)
+		play_feats.append(feats)
+		play_masks.append(masks)
+		state.do_play(*random_agent.pick_plays(feats, masks), active)
+		feats, masks = state.get_draw_features(active)
+		draw_feats.append(feats)
+		draw_masks.append(masks)
+		state.do_draw(random_agent.pick_draws(feats, masks), active)
+		state.swap_player(active)
+
+	play_feats, draw_feats = np.concatenate(play_feats), np.concatenate(draw_feats)
+	report = {
+		'quantization': {
+			'play': quantization_report(agent.play_net, agent.play_qnet, play_feats, np.concatenate(play_masks)),
+			'draw': quantization_report(agent.draw_net, agent.draw_qnet, draw_feats, np.concatenate(draw_masks)),
+		},
+		'sparse_input': {
+			'play': sparse_input_report(agent.play_net, play_feats[np.random.default_rng(1).permutation(len(play_feats))]),
+		},
+	}
+	json.dump(report, sys.stdout, indent=2)
+	print()
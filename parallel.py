@@ -0,0 +1,113 @@
+from multiprocessing import Pool, shared_memory
+import random
+
+import numpy as np
+
+import train
+
+
+"""
+Process-pool self-play data generation.
+
+Each match gets its own seed spawned from a single SeedSequence, and writes its
+trajectory into a fixed slot of preallocated shared-memory buffers, so the output
+is identical for any number of workers. Only the per-match turn counts travel back
+through the pool.
+
+The agent is handed to the workers once, at pool start-up, so it must be picklable
+(or fork-safe). TensorFlow models are neither in general: use batched_self_play for
+network agents and this for cheap ones.
+"""
+
+FEATURE_SIZE = 60 * 5 + 1
+
+_worker = {}
+
+
+def _buffer_specs(num_matches, max_turns):
+	rows = num_matches * max_turns
+	return {
+		'play_X': ((rows, FEATURE_SIZE), np.float32),
+		'draw_X': ((rows, FEATURE_SIZE), np.float32),
+		'play_Y': ((rows, 60 * 2), np.float32),
+		'draw_Y': ((rows, 6), np.float32),
+	}
+
+
+def _attach(buffers, specs):
+	return {
+		name: np.ndarray(shape, dtype=dtype, buffer=buffers[name].buf)
+		for name, (shape, dtype) in specs.items()
+	}
+
+
+def _init_worker(agent, buffer_names, num_matches, max_turns):
+	specs = _buffer_specs(num_matches, max_turns)
+	buffers = {name: shared_memory.SharedMemory(name=buffer_names[name]) for name in specs}
+	_worker['agent'] = agent
+	_worker['max_turns'] = max_turns
+	_worker['buffers'] = buffers  # keep the mappings alive
+	_worker['arrays'] = _attach(buffers, specs)
+
+
+def _play_matches(tasks):
+	""" Play each (match, seed) task into its slot. Each match reseeds random and
+	np.random, so their states are put back afterwards for in-process callers """
+	agent, max_turns, arrays = _worker['agent'], _worker['max_turns'], _worker['arrays']
+	random_state, np_random_state = random.getstate(), np.random.get_state()
+	num_turns = []
+	try:
+		for match, seed in tasks:
+			random.seed(seed)
+			np.random.seed(seed)
+			trajectory = train.self_play_match(agent, max_turns=max_turns)
+
+			start = match * max_turns
+			n = trajectory[0].shape[0]
+			for name, values in zip(('play_X', 'draw_X', 'play_Y', 'draw_Y'), trajectory):
+				arrays[name][start:start + n] = values
+			num_turns.append(n)
+	finally:
+		random.setstate(random_state)
+		np.random.set_state(np_random_state)
+	return num_turns
+
+
+def parallel_self_play(agent, num_matches, num_workers=None, seed=None, max_turns=150, chunk_size=8):
+	""" Plays num_matches self-play matches across num_workers processes (all cores by
+	default) and returns the concatenated (play_X, draw_X, play_Y, draw_Y) arrays,
+	ordered by match. With a fixed seed the result does not depend on num_workers """
+
+	if not isinstance(seed, np.random.SeedSequence):
+		seed = np.random.SeedSequence(seed)
+	seeds = [int(s.generate_state(1)[0]) for s in seed.spawn(num_matches)]
+	tasks = list(enumerate(seeds))
+	chunks = [tasks[i:i + chunk_size] for i in range(0, num_matches, chunk_size)]
+
+	specs = _buffer_specs(num_matches, max_turns)
+	buffers = {
+		name: shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+		for name, (shape, dtype) in specs.items()
+	}
+	try:
+		initargs = (agent, {name: buffer.name for name, buffer in buffers.items()}, num_matches, max_turns)
+		if num_workers == 1:
+			_init_worker(*initargs)
+			turn_counts = [_play_matches(chunk) for chunk in chunks]
+			_worker.clear()
+		else:
+			with Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+				turn_counts = pool.map(_play_matches, chunks)
+
+		num_turns = [n for counts in turn_counts for n in counts]
+		arrays = _attach(buffers, specs)
+		rows = np.concatenate([np.arange(n) + match * max_turns for match, n in enumerate(num_turns)])
+		results = tuple(arrays[name][rows] for name in ('play_X', 'draw_X', 'play_Y', 'draw_Y'))
+		del arrays
+
+	finally:
+		for buffer in buffers.values():
+			buffer.close()
+			buffer.unlink()
+
+	return results
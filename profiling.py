@@ -0,0 +1,108 @@
+from collections import defaultdict
+import json
+import sys
+import time
+
+import numpy as np
+
+
+"""
+Optional per-phase timing for the match and training loops.
+
+Instrumented code asks for a lap function with laps(profiler) and calls lap(phase)
+each time it finishes a phase. The time since the previous lap is charged to that
+phase. Without a profiler, laps returns a function that does nothing, so the only cost
+is one empty call per phase (tens of nanoseconds against tens of microseconds per
+move). Decision phases, i.e. agent inference, also get a latency histogram with
+power-of-two microsecond buckets.
+
+Profiler.write appends everything recorded so far as a JSON line, with games and
+positions per second over the wall time since the last write, and starts afresh.
+"""
+
+DECISION_PHASES = ('play_decision', 'draw_decision')
+HISTOGRAM_BUCKETS = 24  # bucket i holds latencies below 2^i microseconds, the last everything slower
+
+
+def _no_lap(phase):
+	pass
+
+
+def _bucket_label(i):
+	return f'<{2 ** i}' if i < HISTOGRAM_BUCKETS - 1 else f'>={2 ** (i - 1)}'
+
+
+def laps(profiler):
+	""" The lap function to call at the end of each phase, with the clock started now """
+	if profiler is None:
+		return _no_lap
+	profiler.last_lap = time.perf_counter()
+	return profiler.lap
+
+
+class Profiler:
+
+	def __init__(self, path=None):
+		""" Reports are appended to the file at path, or printed if there is none """
+		self.path = path
+		self.reset()
+
+	def reset(self):
+		self.phase_seconds = defaultdict(float)
+		self.phase_calls = defaultdict(int)
+		self.histograms = {phase: np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64) for phase in DECISION_PHASES}
+		self.games = 0
+		self.positions = 0
+		self.started = self.last_lap = time.perf_counter()
+
+	def lap(self, phase):
+		now = time.perf_counter()
+		elapsed = now - self.last_lap
+		self.last_lap = now
+		self.phase_seconds[phase] += elapsed
+		self.phase_calls[phase] += 1
+		if phase in self.histograms:
+			self.histograms[phase][min(int(elapsed * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+			if phase == 'play_decision':
+				self.positions += 1
+
+	def count(self, games=0, positions=0):
+		""" Games played and positions (turns) seen outside of lap, for the throughput
+		figures. Each 'play_decision' lap already counts as a position """
+		self.games += games
+		self.positions += positions
+
+
+	def report(self, **extra):
+		wall = time.perf_counter() - self.started
+		return {
+			**extra,
+			'wall_s': wall,
+			'games': self.games,
+			'positions': self.positions,
+			'games_per_s': self.games / wall,
+			'positions_per_s': self.positions / wall,
+			'phases': {
+				phase: {
+					'total_s': seconds,
+					'calls': self.phase_calls[phase],
+					'mean_us': seconds / self.phase_calls[phase] * 1e6,
+				}
+				for phase, seconds in self.phase_seconds.items()
+			},
+			'latency_histograms_us': {
+				phase: {_bucket_label(i): int(n) for i, n in enumerate(histogram) if n}
+				for phase, histogram in self.histograms.items()
+				if histogram.any()
+			},
+		}
+
+	def write(self, **extra):
+		""" Append the report, plus any extra fields, as one JSON line and reset """
+		line = json.dumps(self.report(**extra))
+		if self.path is None:
+			print(line, file=sys.stdout)
+		else:
+			with open(self.path, 'a') as f:
+				f.write(line + '\n')
+		self.reset()
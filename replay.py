@@ -0,0 +1,162 @@
+import json
+import os
+
+import numpy as np
+
+from dataset import PACKED_SIZE, pack_features, unpack_features, sparse_targets, target_pairs, dense_targets
+
+
+"""
+Disk-backed replay buffer for self-play training data.
+
+Rows are (play_X, draw_X, play_Y, draw_Y) as returned by train.self_play_match, one
+per turn, stored in the compact dataset encoding (bit-packed features, targets as
+action/value pairs, 188 bytes a row) in fixed-capacity .npy files opened as memory
+maps. Only the rows being written or sampled are paged into RAM, and they are only
+expanded back to float32 for the sampled batch. A small JSON file holds the fill level,
+write cursor and RNG state, so a buffer reopened from the same directory carries on
+where it left off.
+
+Once full, new rows evict old ones either first-in-first-out, or by reservoir
+sampling so the buffer stays a uniform sample of everything ever appended.
+"""
+
+COLUMNS = {
+	'play_X': ((PACKED_SIZE,), np.uint8),
+	'draw_X': ((PACKED_SIZE,), np.uint8),
+	'play_action': ((), np.uint8),
+	'play_value': ((), np.int16),
+	'draw_action': ((), np.uint8),
+	'draw_value': ((), np.int16),
+}
+EVICTION_POLICIES = ('fifo', 'reservoir')
+
+
+class ReplayBuffer:
+
+	def __init__(self, directory, capacity=1_000_000, eviction='fifo', seed=None):
+		if eviction not in EVICTION_POLICIES:
+			raise ValueError(f"Unknown eviction policy '{eviction}', expected one of {EVICTION_POLICIES}")
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+
+		self.meta_path = os.path.join(directory, 'meta.json')
+		if os.path.exists(self.meta_path):
+			with open(self.meta_path) as f:
+				meta = json.load(f)
+			if meta['capacity'] != capacity or meta['eviction'] != eviction:
+				raise ValueError(
+					f"Replay buffer in {directory} has capacity={meta['capacity']}, "
+					f"eviction={meta['eviction']}, not capacity={capacity}, eviction={eviction}"
+				)
+			self.size, self.cursor, self.seen = meta['size'], meta['cursor'], meta['seen']
+			self.rng = np.random.default_rng()
+			self.rng.bit_generator.state = meta['rng_state']
+			mode = 'r+'
+		else:
+			self.size, self.cursor, self.seen = 0, 0, 0
+			self.rng = np.random.default_rng(seed)
+			mode = 'w+'
+
+		self.capacity = capacity
+		self.eviction = eviction
+		self.arrays = {
+			name: np.lib.format.open_memmap(
+				os.path.join(directory, f'{name}.npy'), mode=mode, dtype=dtype, shape=(capacity, *shape))
+			for name, (shape, dtype) in COLUMNS.items()
+		}
+		if mode == 'w+':
+			self.flush()
+
+
+	def __len__(self):
+		return self.size
+
+
+	def _slots_for(self, num_rows):
+		""" Buffer slot for each incoming row, or -1 where reservoir sampling drops it """
+		if self.eviction == 'fifo':
+			slots = (self.cursor + np.arange(num_rows)) % self.capacity
+			self.cursor = (self.cursor + num_rows) % self.capacity
+			return slots
+
+		positions = self.seen + np.arange(num_rows)
+		slots = np.where(positions < self.capacity, positions, -1)
+		full = positions >= self.capacity
+		candidates = self.rng.integers(0, positions[full] + 1)
+		slots[full] = np.where(candidates < self.capacity, candidates, -1)
+		return slots
+
+	def append(self, play_X, draw_X, play_Y, draw_Y):
+		num_rows = play_X.shape[0]
+		slots = self._slots_for(num_rows)
+		keep = slots >= 0
+		# Later rows win if reservoir sampling picks the same slot twice in one append
+		slots, rows = slots[keep], np.flatnonzero(keep)
+
+		columns = (
+			pack_features(play_X[rows]), pack_features(draw_X[rows]),
+			*sparse_targets(play_Y[rows]), *sparse_targets(draw_Y[rows]),
+		)
+		for name, values in zip(COLUMNS, columns):
+			self.arrays[name][slots] = values
+
+		self.seen += num_rows
+		self.size = min(self.size + num_rows, self.capacity)
+		self.flush()
+
+
+	def sample(self, batch_size, sparse=False):
+		""" Uniformly random rows, without replacement where possible. With sparse=True the
+		targets come back as (action, value) pairs instead of dense SENTINEL rows """
+		indices = self.rng.choice(self.size, size=batch_size, replace=batch_size > self.size)
+		indices.sort()  # read the memory maps in order
+		rows = {name: array[indices] for name, array in self.arrays.items()}
+		if sparse:
+			play_Y = target_pairs(rows['play_action'], rows['play_value'])
+			draw_Y = target_pairs(rows['draw_action'], rows['draw_value'])
+		else:
+			play_Y = dense_targets(rows['play_action'], rows['play_value'], 60 * 2)
+			draw_Y = dense_targets(rows['draw_action'], rows['draw_value'], 6)
+		return unpack_features(rows['play_X']), unpack_features(rows['draw_X']), play_Y, draw_Y
+
+
+	def chunks(self, chunk_size=4096, num_rows=None, sparse=False):
+		""" Yield decoded (play_X, draw_X, play_Y, draw_Y) runs of consecutive rows, starting
+		from random offsets, until num_rows have been produced. num_rows defaults to, and is
+		capped at, the whole buffer, so no row is produced twice and an empty buffer yields
+		nothing. Meant for streaming into a shuffle buffer, see train.trajectory_datasets """
+		remaining = self.size if num_rows is None else min(num_rows, self.size)
+		if remaining <= 0:
+			return
+		for start in self.rng.permutation(np.arange(0, self.size, chunk_size)):
+			# Slots from size on are unfilled until the buffer is full
+			stop = min(start + chunk_size, start + remaining, self.size)
+			rows = {name: array[start:stop] for name, array in self.arrays.items()}
+			if sparse:
+				play_Y = target_pairs(rows['play_action'], rows['play_value'])
+				draw_Y = target_pairs(rows['draw_action'], rows['draw_value'])
+			else:
+				play_Y = dense_targets(rows['play_action'], rows['play_value'], 60 * 2)
+				draw_Y = dense_targets(rows['draw_action'], rows['draw_value'], 6)
+			yield unpack_features(rows['play_X']), unpack_features(rows['draw_X']), play_Y, draw_Y
+
+			remaining -= play_Y.shape[0]
+			if remaining <= 0:
+				return
+
+
+	def flush(self):
+		for array in self.arrays.values():
+			array.flush()
+		meta = {
+			'capacity': self.capacity,
+			'eviction': self.eviction,
+			'size': self.size,
+			'cursor': self.cursor,
+			'seen': self.seen,
+			'rng_state': self.rng.bit_generator.state,
+		}
+		with open(self.meta_path + '.tmp', 'w') as f:
+			json.dump(meta, f)
+		os.replace(self.meta_path + '.tmp', self.meta_path)
@@ -5,7 +5,7 @@ import math
 import numpy as np
 import pygame
 
-from gamestate import GameState, RED, GREEN, WHITE, BLUE, YELLOW, NUM_COLOURS, DECK, Card
+from gamestate import GameState, RED, GREEN, WHITE, BLUE, YELLOW, NUM_COLOURS, DECK, CARD_COLOURS, CARD_VALUES, CARD_LABELS
 
 
 pygame.init()
@@ -56,8 +56,8 @@ class CardSprite():
             self.colour = "DRAW"
             self.label = '?'
         else:
-            self.colour, self.value , self.label = card.colour, card.value, card.label
-            self.index = card.index
+            self.colour, self.value, self.label = int(CARD_COLOURS[card]), int(CARD_VALUES[card]), str(CARD_LABELS[card])
+            self.index = card
         
         self.back_colour = tuple(map(lambda x: 0.4*(x + 50), ColourMap[self.colour]))
 
@@ -357,7 +357,7 @@ class TableGUI:
 
     def opponent_play(self, card_choice, is_discard):
         card = CardSprite(
-            Card(card_choice),
+            card_choice,
             x=self.SCRN_W // 2,
             y=-CardSprite.HEIGHT
         )
@@ -385,7 +385,7 @@ class TableGUI:
             self.deck_size -= 1
             card = CardSprite(None, x=self.deck_sprite.rect.x, y=self.deck_sprite.rect.y)
         else:
-            card = self.discard_piles[drawn_card.colour].pop()
+            card = self.discard_piles[CARD_COLOURS[drawn_card]].pop()
 
         self.opponent_hand.append(card)
         self._move_card(card,
@@ -0,0 +1,272 @@
+from multiprocessing import Pool
+import os
+import random
+from statistics import NormalDist
+import time
+
+import numpy as np
+
+from agent import NumpyDenseAgent
+import train
+
+
+"""
+Round-robin tournaments between agents, played on a process pool.
+
+Every pair of entrants plays games_per_pair games. Games come in pairs dealt from the
+same seed, once with each entrant moving first, so neither the first-move advantage
+nor the luck of the deal favours either side. Each game has its own seed spawned from
+one SeedSequence, so results do not depend on the number of workers.
+
+Entrants are Agent instances, which must be picklable (or fork-safe), or checkpoint
+directories written by NumpyDenseAgent.save, which each worker loads once without
+TensorFlow. Keras-backed agents should be exported that way first.
+
+Ratings are Bradley-Terry strengths on the Elo scale (a 400 point gap means 10:1 odds),
+with wins as 1, draws as 1/2, and normal confidence intervals from the curvature of the
+fitted log-likelihood.
+
+For a yes/no answer to "is this agent better than that one", sprt plays the same kind
+of paired deals between just the two, reseeding both games of a pair identically so the
+agents' own random choices are common to both seatings too, and stops as soon as a
+sequential probability ratio test on the paired score deltas reaches a verdict.
+"""
+
+ELO_PER_NAT = 400 / np.log(10)
+
+_worker = {}
+
+
+def _load(entrant):
+	return NumpyDenseAgent.load(entrant) if isinstance(entrant, str) else entrant
+
+
+def _init_worker(entrants, max_turns, profiler=None):
+	_worker['agents'] = [_load(entrant) for entrant in entrants]
+	_worker['max_turns'] = max_turns
+	_worker['profiler'] = profiler
+
+
+def _play_games(tasks):
+	""" Score deltas for the first of each (first, second, seed) task. Each game reseeds
+	random and np.random, so their states are put back afterwards for in-process callers """
+	agents, max_turns, profiler = _worker['agents'], _worker['max_turns'], _worker['profiler']
+	random_state, np_random_state = random.getstate(), np.random.get_state()
+	deltas = []
+	try:
+		for first, second, seed in tasks:
+			random.seed(seed)
+			np.random.seed(seed)
+			deltas.append(train.play_match(agents[first], agents[second], max_turns=max_turns, profiler=profiler))
+	finally:
+		random.setstate(random_state)
+		np.random.set_state(np_random_state)
+	return deltas
+
+
+def bradley_terry(points, games, prior_draws=1.0, max_iterations=10_000, tolerance=1e-10):
+	""" Elo-scale ratings, averaging 0, from points[i, j] scored by i against j over
+	games[i, j] games. prior_draws virtual drawn games per pairing keep the ratings of
+	unbeaten or winless entrants finite. Fitted with Hunter's MM algorithm """
+	n = points.shape[0]
+	others = ~np.eye(n, dtype=bool)
+	games = games + prior_draws * others
+	wins = np.sum(points + prior_draws / 2 * others, axis=1)
+
+	strength = np.ones(n)
+	for _ in range(max_iterations):
+		updated = wins / np.sum(games / (strength[:, None] + strength[None, :]), axis=1)
+		updated /= np.exp(np.mean(np.log(updated)))
+		converged = np.max(np.abs(updated - strength)) < tolerance
+		strength = updated
+		if converged:
+			break
+	return 400 * np.log10(strength)
+
+
+def bradley_terry_errors(ratings, games, prior_draws=1.0):
+	""" Standard errors of bradley_terry ratings, from the Fisher information of the same
+	log-likelihood, prior draws included, at the fitted ratings. Unlike resampling games,
+	this stays positive for a pairing that had the same result every game """
+	n = ratings.shape[0]
+	others = ~np.eye(n, dtype=bool)
+	games = games + prior_draws * others
+	# p[i, j] is the chance that i beats j
+	p = 1 / (1 + np.exp((ratings[None, :] - ratings[:, None]) / ELO_PER_NAT))
+	weights = games * p * p.T
+	information = np.diag(np.sum(weights, axis=1)) - weights
+	# Ratings are only defined up to a common shift, pinned down by averaging 0, and the
+	# pseudo-inverse is the covariance under that constraint
+	return ELO_PER_NAT * np.sqrt(np.diag(np.linalg.pinv(information)))
+
+
+def _points_and_games(n, pairs, outcomes):
+	""" Totals for bradley_terry from per-game outcomes (1, 1/2 or 0 for the first entrant
+	of each pair) """
+	points, games = np.zeros((n, n)), np.zeros((n, n))
+	for (i, j), scores in zip(pairs, outcomes):
+		points[i, j] += np.sum(scores)
+		points[j, i] += np.sum(1 - scores)
+		games[i, j] += scores.size
+		games[j, i] += scores.size
+	return points, games
+
+
+def tournament(
+	entrants, games_per_pair=100, num_workers=None, seed=None, max_turns=150, chunk_size=2,
+	confidence=0.95,
+):
+	""" Play a round robin between entrants, a dict of name -> Agent or checkpoint directory,
+	across num_workers processes (all cores by default). Returns a report dict with each
+	entrant's rating and confidence interval, and per-pairing results """
+	names = list(entrants)
+	n = len(names)
+	pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+	if not isinstance(seed, np.random.SeedSequence):
+		seed = np.random.SeedSequence(seed)
+	pair_seeds = seed.spawn(len(pairs))
+	tasks = []
+	for (i, j), pair_seed in zip(pairs, pair_seeds):
+		deal_seeds = [int(s.generate_state(1)[0]) for s in pair_seed.spawn((games_per_pair + 1) // 2)]
+		for game in range(games_per_pair):
+			deal = deal_seeds[game // 2]
+			tasks.append((i, j, deal) if game % 2 == 0 else (j, i, deal))
+	chunks = [tasks[k:k + chunk_size] for k in range(0, len(tasks), chunk_size)]
+
+	start = time.perf_counter()
+	initargs = ([entrants[name] for name in names], max_turns)
+	if num_workers == 1:
+		_init_worker(*initargs)
+		deltas = [_play_games(chunk) for chunk in chunks]
+		_worker.clear()
+	else:
+		with Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+			deltas = pool.map(_play_games, chunks)
+	seconds = time.perf_counter() - start
+
+	# Deltas from the point of view of each pair's first entrant, then as 1 / 0.5 / 0 outcomes
+	deltas = np.array([delta for chunk in deltas for delta in chunk], dtype=np.float64)
+	deltas = deltas.reshape((len(pairs), games_per_pair))
+	deltas[:, 1::2] *= -1
+	outcomes = (np.sign(deltas) + 1) / 2
+
+	points, games = _points_and_games(n, pairs, outcomes)
+	ratings = bradley_terry(points, games)
+	margin = NormalDist().inv_cdf(0.5 + confidence / 2) * bradley_terry_errors(ratings, games)
+	low, high = ratings - margin, ratings + margin
+
+	order = np.argsort(-ratings)
+	return {
+		'ratings': {
+			names[i]: {'elo': float(ratings[i]), 'ci_low': float(low[i]), 'ci_high': float(high[i])}
+			for i in order
+		},
+		'pairings': {
+			f'{names[i]} vs {names[j]}': {
+				'games': games_per_pair,
+				'wins': int(np.sum(scores == 1)),
+				'draws': int(np.sum(scores == 0.5)),
+				'losses': int(np.sum(scores == 0)),
+				'mean_delta': float(np.mean(pair_deltas)),
+			}
+			for (i, j), scores, pair_deltas in zip(pairs, outcomes, deltas)
+		},
+		'confidence': confidence,
+		'games': len(tasks),
+		'seconds': seconds,
+		'games_per_s': len(tasks) / seconds,
+	}
+
+
+def sprt_llr(samples, mean0, mean1):
+	""" Log-likelihood ratio of mean1 against mean0 for normally distributed samples, with
+	the variance estimated from the samples themselves """
+	samples = np.asarray(samples, dtype=np.float64)
+	variance = max(np.var(samples, ddof=1), 1e-9)
+	return samples.size * (mean1 - mean0) * (np.mean(samples) - (mean0 + mean1) / 2) / variance
+
+
+def sprt(
+	agent, opponent, delta0=0.0, delta1=5.0, alpha=0.05, beta=0.05, min_pairs=10, max_pairs=500,
+	num_workers=1, seed=None, max_turns=150, profiler=None,
+):
+	""" Sequential test of H0: agent's mean score delta against opponent is delta0, against
+	H1: it is delta1, with false positive rate alpha and false negative rate beta. Each
+	sample is the average of agent's deltas over one deal played from both seats. Pairs
+	are played until the log-likelihood ratio leaves (log(beta / (1 - alpha)),
+	log((1 - beta) / alpha)) or max_pairs is reached, num_workers pairs at a time in a
+	process pool, or one at a time in-process with the default num_workers=1 (needed for
+	agents that can't be pickled, e.g. Keras ones). A profiling.Profiler, which needs
+	num_workers=1, times the games' phases. Returns a report dict whose 'verdict' is 'H1',
+	'H0' or 'inconclusive' """
+	if profiler is not None and num_workers != 1:
+		raise ValueError("Profiling sprt games needs num_workers=1")
+	lower, upper = np.log(beta / (1 - alpha)), np.log((1 - beta) / alpha)
+	if not isinstance(seed, np.random.SeedSequence):
+		seed = np.random.SeedSequence(seed)
+	deal_seeds = [int(s.generate_state(1)[0]) for s in seed.spawn(max_pairs)]
+
+	initargs = ([agent, opponent], max_turns, profiler)
+	if num_workers == 1:
+		_init_worker(*initargs)
+		pool, batch_size = None, 1
+	else:
+		pool = Pool(num_workers, initializer=_init_worker, initargs=initargs)
+		batch_size = num_workers or os.cpu_count()
+
+	start = time.perf_counter()
+	paired_deltas, llr = [], 0.0
+	try:
+		while len(paired_deltas) < max_pairs:
+			batch = deal_seeds[len(paired_deltas):len(paired_deltas) + batch_size]
+			tasks = [[(0, 1, deal), (1, 0, deal)] for deal in batch]
+			results = map(_play_games, tasks) if pool is None else pool.map(_play_games, tasks)
+			paired_deltas.extend((first - second) / 2 for first, second in results)
+
+			if len(paired_deltas) >= min_pairs:
+				llr = sprt_llr(paired_deltas, delta0, delta1)
+				if not lower < llr < upper:
+					break
+	finally:
+		if pool is None:
+			_worker.clear()
+		else:
+			pool.terminate()
+
+	verdict = 'inconclusive'
+	if llr >= upper:
+		verdict = 'H1'
+	elif llr <= lower:
+		verdict = 'H0'
+	return {
+		'verdict': verdict,
+		'llr': float(llr),
+		'bounds': [float(lower), float(upper)],
+		'pairs': len(paired_deltas),
+		'games': 2 * len(paired_deltas),
+		'mean_delta': float(np.mean(paired_deltas)),
+		'std_paired_delta': float(np.std(paired_deltas, ddof=1)) if len(paired_deltas) > 1 else None,
+		'seconds': time.perf_counter() - start,
+	}
+
+
+if __name__ == '__main__':
+	import json
+	import sys
+
+	from agent import RandomAgent
+	from mcts import MCTSAgent
+
+	cautious = RandomAgent()
+	cautious.PLAY_VS_DISCARD_WEIGHTING = 0.5
+	eager = RandomAgent()
+	eager.PLAY_VS_DISCARD_WEIGHTING = 2
+	entrants = {
+		'random': RandomAgent(),
+		'random_cautious': cautious,
+		'random_eager': eager,
+		'mcts_16': MCTSAgent(num_simulations=16),
+	}
+	json.dump(tournament(entrants, games_per_pair=20, seed=0), sys.stdout, indent=2)
+	print()
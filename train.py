@@ -1,71 +1,97 @@
 import numpy as np
-import tensorflow.keras.backend as K
-from tqdm import tqdm
 
 from agent import RandomAgent, DenseAgent, MinAgent
+from batchedstate import BatchedGameState
+from dataset import SENTINEL, sparse_targets, target_pairs
 from gamestate import GameState, DECK
+import parallel
+import profiling
+from replay import ReplayBuffer
+import tournament
 
-SENTINEL = 9999
 
-
-def play_match(A, B, max_turns=150):
-	state = GameState()
+def play_match(A, B, max_turns=150, state_class=GameState, profiler=None):
+	""" Final score delta for A. A profiling.Profiler, if given, gets per-phase timings """
+	lap = profiling.laps(profiler)
+	state = state_class()
 	state.init_random_game()
+	lap('engine')
 
 	for turn in range(0, max_turns, 2):
 		input_feats, output_mask = state.get_play_features()
+		lap('features')
 		card_choice, is_discard = A.pick_play(input_feats, output_mask)
+		lap('play_decision')
 		state.do_play(card_choice, is_discard)
+		lap('engine')
 		input_feats, output_mask = state.get_draw_features()
+		lap('features')
 		draw_choice = A.pick_draw(input_feats, output_mask)
+		lap('draw_decision')
 		drawn_card = state.do_draw(draw_choice)
 
 		if state.is_finished():
 			break
 		state.swap_player()
+		lap('engine')
 
 		input_feats, output_mask = state.get_play_features()
+		lap('features')
 		card_choice, is_discard = B.pick_play(input_feats, output_mask)
+		lap('play_decision')
 		state.do_play(card_choice, is_discard)
+		lap('engine')
 		input_feats, output_mask = state.get_draw_features()
+		lap('features')
 		draw_choice = B.pick_draw(input_feats, output_mask)
+		lap('draw_decision')
 		drawn_card = state.do_draw(draw_choice)
 
 		state.swap_player()
+		lap('engine')
 		if state.is_finished():
 			break
 
+	lap('engine')
+	if profiler is not None:
+		profiler.count(games=1)
 	return state.get_score_delta()
 
 
 
-def self_play_match(agent, exploration_factor=0, max_turns=150):
+def self_play_match(agent, exploration_factor=0, max_turns=150, state_class=GameState, profiler=None):
 
+	lap = profiling.laps(profiler)
 	play_feats = np.empty((max_turns, 60 * 5 + 1), dtype=np.float32)
 	draw_feats = np.empty((max_turns, 60 * 5 + 1), dtype=np.float32)
 	play_choices = np.empty(max_turns, dtype=int)
 	draw_choices = np.empty(max_turns, dtype=int)
 
-	state = GameState()
+	state = state_class()
 	state.init_random_game()
+	lap('engine')
 
 	for turn in range(max_turns):
 		if state.is_finished():  # Check first, so that 'turn' has correct value after loop
 			break
 
-		input_feats, output_mask = state.get_play_features()
+		input_feats, output_mask = state.get_play_features(out=play_feats[turn])
+		lap('features')
 		card_choice, is_discard = agent.pick_play(input_feats, output_mask)
+		lap('play_decision')
 		state.do_play(card_choice, is_discard)
-		play_feats[turn] = input_feats
 		play_choices[turn] = 2 * card_choice + is_discard
+		lap('engine')
 
-		input_feats, output_mask = state.get_draw_features()
+		input_feats, output_mask = state.get_draw_features(out=draw_feats[turn])
+		lap('features')
 		draw_choice = agent.pick_draw(input_feats, output_mask)
+		lap('draw_decision')
 		drawn_card = state.do_draw(draw_choice)
-		draw_feats[turn] = input_feats
 		draw_choices[turn] = draw_choice
 
 		state.swap_player()
+		lap('engine')
 
 	num_turns = turn
 
@@ -74,6 +100,64 @@ def self_play_match(agent, exploration_factor=0, max_turns=150):
 	if state.current_player:
 		p0_score *= -1
 
+	play_choice_feats, draw_choice_feats = _choice_targets(play_choices, draw_choices, num_turns, p0_score)
+	play_feats, draw_feats = play_feats[:num_turns], draw_feats[:num_turns]
+	lap('targets')
+	if profiler is not None:
+		profiler.count(games=1)
+
+	return play_feats, draw_feats, play_choice_feats, draw_choice_feats
+
+
+def batched_self_play(agent, num_games, max_turns=150, rng=None):
+	""" Plays num_games self-play matches in lockstep, asking the agent for one batch of
+	decisions per step. Returns a list of per-game trajectories in the same format as
+	self_play_match """
+
+	play_feats = np.empty((num_games, max_turns, 60 * 5 + 1), dtype=np.float32)
+	draw_feats = np.empty((num_games, max_turns, 60 * 5 + 1), dtype=np.float32)
+	play_choices = np.empty((num_games, max_turns), dtype=int)
+	draw_choices = np.empty((num_games, max_turns), dtype=int)
+	num_turns = np.zeros(num_games, dtype=int)
+
+	state = BatchedGameState(num_games)
+	state.init_random_games(rng)
+
+	active = np.arange(num_games)
+	for turn in range(max_turns):
+		active = active[~state.is_finished(active)]
+		if not active.size:
+			break
+
+		input_feats, output_masks = state.get_play_features(active)
+		card_choices, is_discard = agent.pick_plays(input_feats, output_masks)
+		state.do_play(card_choices, is_discard, active)
+		play_feats[active, turn] = input_feats
+		play_choices[active, turn] = 2 * card_choices + is_discard
+
+		input_feats, output_masks = state.get_draw_features(active)
+		draw_choice = agent.pick_draws(input_feats, output_masks)
+		state.do_draw(draw_choice, active)
+		draw_feats[active, turn] = input_feats
+		draw_choices[active, turn] = draw_choice
+
+		state.swap_player(active)
+		num_turns[active] = turn + 1
+
+	p0_scores = state.get_score_deltas()
+	p0_scores[state.current_player == 1] *= -1
+
+	trajectories = []
+	for game in range(num_games):
+		n = num_turns[game]
+		play_choice_feats, draw_choice_feats = _choice_targets(
+			play_choices[game], draw_choices[game], n, p0_scores[game])
+		trajectories.append((play_feats[game, :n], draw_feats[game, :n], play_choice_feats, draw_choice_feats))
+
+	return trajectories
+
+
+def _choice_targets(play_choices, draw_choices, num_turns, p0_score):
 	turn_idxs = np.arange(num_turns)
 	play_choice_feats = np.full((num_turns, 60 * 2), SENTINEL, dtype=np.float32)
 	play_choice_feats[turn_idxs[::2], play_choices[:num_turns:2]] = p0_score
@@ -81,9 +165,7 @@ def self_play_match(agent, exploration_factor=0, max_turns=150):
 	draw_choice_feats = np.full((num_turns, 6), SENTINEL, dtype=np.float32)
 	draw_choice_feats[turn_idxs[::2], draw_choices[:num_turns:2]] = p0_score
 	draw_choice_feats[turn_idxs[1::2], draw_choices[1:num_turns:2]] = -p0_score
-	play_feats, draw_feats = play_feats[:num_turns], draw_feats[:num_turns]
-
-	return play_feats, draw_feats, play_choice_feats, draw_choice_feats
+	return play_choice_feats, draw_choice_feats
 
 
 def dual_shuffle(a, b):
@@ -93,48 +175,125 @@ def dual_shuffle(a, b):
 
 def squared_error_masked(y_true, y_pred):
     """ Squared error of elements where y_true is not 0 """
+    import tensorflow.keras.backend as K  # TensorFlow is only loaded once training starts
+
     err = y_pred - y_true  # K.cast(y_true, y_pred.dtype)
     return K.sum(K.square(err) * K.cast(K.not_equal(y_true, SENTINEL), y_pred.dtype), axis=-1)
 
-
-def train():
+def squared_error_sparse(y_true, y_pred):
+	""" Squared error of the one output picked by each (action index, value) row of y_true.
+	Same loss as squared_error_masked on the equivalent dense targets """
+	import tensorflow as tf
+	import tensorflow.keras.backend as K
+
+	actions = K.cast(y_true[:, 0], 'int32')
+	return K.square(tf.gather(y_pred, actions, batch_dims=1) - y_true[:, 1])
+
+
+def trajectory_datasets(make_chunks, batch_size=32, shuffle_buffer=10_000, sparse=True, joint=False):
+	""" Streaming tf.data pipelines for the play and draw models. make_chunks() must return a
+	fresh iterable of (play_X, draw_X, play_Y, draw_Y) chunks on every call (once per epoch
+	per model), with targets already in the form the loss expects, e.g. a list of
+	self_play_match trajectories or a ReplayBuffer.chunks generator. Rows are shuffled
+	through a bounded buffer, batched and prefetched while the model trains.
+	With joint=True there is a single pipeline of ((play_X, draw_X), (play_Y, draw_Y)) rows
+	from the same turn, for the joint model of a shared-trunk DenseAgent """
+	import tensorflow as tf
+
+	def pipeline(x_column, y_column, y_width):
+		def rows():
+			for chunk in make_chunks():
+				yield chunk[x_column], chunk[y_column]
+
+		dataset = tf.data.Dataset.from_generator(rows, output_signature=(
+			tf.TensorSpec(shape=(None, 60 * 5 + 1), dtype=tf.float32),
+			tf.TensorSpec(shape=(None, y_width), dtype=tf.float32),
+		))
+		return dataset.unbatch().shuffle(shuffle_buffer).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+	if joint:
+		def turns():
+			for play_X, draw_X, play_Y, draw_Y in make_chunks():
+				yield (play_X, draw_X), (play_Y, draw_Y)
+
+		state_spec = tf.TensorSpec(shape=(None, 60 * 5 + 1), dtype=tf.float32)
+		dataset = tf.data.Dataset.from_generator(turns, output_signature=(
+			(state_spec, state_spec),
+			(
+				tf.TensorSpec(shape=(None, 2 if sparse else 60 * 2), dtype=tf.float32),
+				tf.TensorSpec(shape=(None, 2 if sparse else 6), dtype=tf.float32),
+			),
+		))
+		return dataset.unbatch().shuffle(shuffle_buffer).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+	play_dataset = pipeline(0, 2, 2 if sparse else 60 * 2)
+	draw_dataset = pipeline(1, 3, 2 if sparse else 6)
+	return play_dataset, draw_dataset
+
+
+def train(
+	num_workers=None, seed=None, replay_dir=None, replay_capacity=1_000_000, replay_eviction='fifo',
+	sparse=True, shared_trunk=False, profile_path=None,
+):
+	""" num_workers=None generates self-play data on every core, 1 keeps it in-process.
+	With a replay_dir, each iteration's data goes into a ReplayBuffer there and each epoch
+	streams the same number of rows from random stretches of everything the buffer holds.
+	sparse=True trains on (action, value) targets with squared_error_sparse rather than
+	dense SENTINEL rows with squared_error_masked. shared_trunk=True trains one network
+	with play and draw heads in a single fit instead of two separate networks. With a
+	profile_path, each iteration appends two profiling.Profiler reports there as JSON lines:
+	stage 'train', in which evaluation is one 'eval' phase, and stage 'eval' with the
+	phases, decision latencies and throughput of the evaluation games alone """
 
 	random_agent = RandomAgent()
-	training_agent = DenseAgent(exploration_prob=0.15)
-	training_agent.compile_models_for_training(loss=squared_error_masked)
+	training_agent = DenseAgent(exploration_prob=0.15, shared_trunk=shared_trunk)
+	training_agent.compile_models_for_training(loss=squared_error_sparse if sparse else squared_error_masked)
 	eval_agent = DenseAgent(exploration_prob=0, existing_agent=training_agent)
+	seeds = np.random.SeedSequence(seed).spawn(20)
+	replay_buffer = None
+	if replay_dir is not None:
+		replay_buffer = ReplayBuffer(replay_dir, capacity=replay_capacity, eviction=replay_eviction, seed=seed)
+	profiler = eval_profiler = None
+	if profile_path is not None:
+		profiler, eval_profiler = profiling.Profiler(profile_path), profiling.Profiler(profile_path)
 
 	for i in range(20):
-		
-		all_play_X, all_draw_X, all_play_Y, all_draw_Y = [], [], [], []	
-		for match in tqdm(range(100)):
-			play_X, draw_X, play_Y, draw_Y = self_play_match(random_agent)
-			all_play_X.append(play_X)
-			all_play_Y.append(play_Y)
-			all_draw_X.append(draw_X)
-			all_draw_Y.append(draw_Y)
-
-		play_X = np.concatenate(all_play_X, axis=0)
-		play_Y = np.concatenate(all_play_Y, axis=0)
-		draw_X = np.concatenate(all_draw_X, axis=0)
-		draw_Y = np.concatenate(all_draw_Y, axis=0)
-
-		play_X, play_Y = dual_shuffle(play_X, play_Y)
-		draw_X, draw_Y = dual_shuffle(draw_X, draw_Y)
-		
-		training_agent.play_model.fit(
-			x=play_X,
-			y=play_Y,
-			epochs=3,
+		lap = profiling.laps(profiler)
+		play_X, draw_X, play_Y, draw_Y = parallel.parallel_self_play(
+			random_agent, num_matches=100, num_workers=num_workers, seed=seeds[i])
+		lap('self_play')
+		if profiler is not None:
+			profiler.count(games=100, positions=play_X.shape[0])
+		if replay_buffer is not None:
+			replay_buffer.append(play_X, draw_X, play_Y, draw_Y)
+			num_rows = play_X.shape[0]
+			make_chunks = lambda: replay_buffer.chunks(num_rows=num_rows, sparse=sparse)
+		else:
+			if sparse:
+				play_Y, draw_Y = target_pairs(*sparse_targets(play_Y)), target_pairs(*sparse_targets(draw_Y))
+			chunks = [(play_X, draw_X, play_Y, draw_Y)]
+			make_chunks = lambda: chunks
+		lap('replay' if replay_buffer is not None else 'targets')
+
+		if shared_trunk:
+			training_agent.model.fit(trajectory_datasets(make_chunks, sparse=sparse, joint=True), epochs=3)
+		else:
+			play_dataset, draw_dataset = trajectory_datasets(make_chunks, sparse=sparse)
+			training_agent.play_model.fit(play_dataset, epochs=3)
+			training_agent.draw_model.fit(draw_dataset, epochs=3)
+		lap('fit')
+
+		if eval_profiler is not None:
+			eval_profiler.reset()
+		result = tournament.sprt(eval_agent, random_agent, seed=seeds[i], profiler=eval_profiler)
+		lap('eval')
+		print(
+			f"Eval: {result['verdict']} after {result['games']} games, avg={result['mean_delta']:.2f}, "
+			f"llr={result['llr']:.2f} in {result['bounds']}"
 		)
-		training_agent.draw_model.fit(
-			x=draw_X,
-			y=draw_Y,
-			epochs=3,
-		)
-
-		scores = [play_match(eval_agent, random_agent) for _ in tqdm(range(10))]
-		print(f'Eval: avg={sum(scores)/len(scores)}, {scores=}')
+		if profiler is not None:
+			profiler.write(stage='train', iteration=i, eval_avg=result['mean_delta'], eval_games=result['games'])
+			eval_profiler.write(stage='eval', iteration=i)
     
 
 
@@ -173,6 +332,5 @@ if __name__ == "__main__":
 	randy = RandomAgent()
 	minny = MinAgent(play_handshakes=False)
 
-
-	scores = [play_match(minny, randy) for _ in tqdm(range(1000))]
-	print(f'Eval: avg={sum(scores)/len(scores)}')
\ No newline at end of file
+	report = tournament.tournament({'minny': minny, 'randy': randy}, games_per_pair=1000)
+	print(f"Eval: avg={report['pairings']['minny vs randy']['mean_delta']}, ratings={report['ratings']}")
\ No newline at end of file